@@ -1,37 +1,37 @@
 """
 Gradio app for SQL Query Generator - Hugging Face Spaces deployment.
 """
-import gradio as gr
 import os
+
+# Должно быть установлено до импорта huggingface_hub (в т.ч. через gradio)
+os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+import gradio as gr
+import asyncio
 import sys
+import threading
+from huggingface_hub import hf_hub_download
 from sql_generator import SQLQueryGenerator
-import subprocess
 
 # Global variable to store the generator
 generator = None
 from spaces import GPU
-print("🔄 Загрузка LFS файлов...")
-try:
-    # Скачиваем LFS файлы
-    result = subprocess.run(
-        ["git", "lfs", "pull"], 
-        capture_output=True, 
-        text=True,
-        timeout=60  # 60 секунд таймаут
-    )
-    if result.returncode == 0:
-        print("✅ LFS файлы успешно загружены!")
-        if os.path.exists("example_dataset.parquet"):
-            file_size = os.path.getsize("example_dataset.parquet") / (1024 * 1024)
-            print(f"📊 Dataset загружен: {file_size:.1f} MB")
-        else:
-            print("❌ Файл dataset не найден после LFS pull")
-    else:
-        print(f"⚠️ LFS ошибка: {result.stderr}")
-except subprocess.TimeoutExpired:
-    print("⏰ Таймаут загрузки LFS файлов")
-except Exception as e:
-    print(f"❌ Ошибка LFS: {e}")
+
+hf_repo_id = os.getenv("HF_REPO_ID")
+if hf_repo_id:
+    print(f"🔄 Загрузка dataset из {hf_repo_id}...")
+    try:
+        # Скачиваем dataset через Hub (hf_transfer качает в несколько потоков)
+        hf_hub_download(
+            repo_id=hf_repo_id,
+            filename="example_dataset.parquet",
+            repo_type="dataset",
+            local_dir="."
+        )
+        file_size = os.path.getsize("example_dataset.parquet") / (1024 * 1024)
+        print(f"📊 Dataset загружен: {file_size:.1f} MB")
+    except Exception as e:
+        print(f"❌ Ошибка загрузки dataset: {e}")
 
 # Проверяем существование файла
 if os.path.exists("example_dataset.parquet"):
@@ -39,45 +39,124 @@ if os.path.exists("example_dataset.parquet"):
 else:
     print("❌ Dataset не доступен, будут использоваться fallback данные")
 
+# Модель грузится в фоновом потоке, чтобы UI открывался сразу
+_ready = threading.Event()
+_init_status = "⚠️ Please wait for the model to load. This may take a few minutes on first run."
+LOADING_MESSAGE = _init_status
+
+def _load_generator():
+    """Build the SQL Query Generator and record the outcome in _init_status."""
+    global generator, _init_status
+    print("Initializing SQL Query Generator...")
+    try:
+        dataset_path = os.getenv("DATASET_PATH", "example_dataset.parquet")
+        model_name = os.getenv("MODEL_NAME", "NousResearch/Nous-Hermes-llama-2-7b")
+        use_quantization = os.getenv("USE_QUANTIZATION", "true").lower() == "true"
+        quant_mode = os.getenv("QUANT_MODE", "nf4")
+        
+        print("Loading dataset schema...")
+        generator = SQLQueryGenerator(
+            dataset_path=dataset_path,
+            model_name=model_name,
+            use_quantization=use_quantization,
+            device_map="auto",
+            quant_mode=quant_mode
+        )
+        print("Initialization complete!")
+        print("SQL Query Generator initialized successfully!")
+        _init_status = "✅ SQL Query Generator initialized successfully!"
+    except Exception as e:
+        _init_status = f"❌ Error initializing generator: {str(e)}"
+        print(_init_status)
+        import traceback
+        traceback.print_exc()
+
 @GPU
-def dummy_gpu_function():
-    # Пустая функция только для инициализации GPU
-    return "GPU initialized"
+def _warmup_generator():
+    """Prime CUDA kernels with a generation on a real schema prompt."""
+    if generator is not None:
+        generator.warmup()
 
-# Вызовите один раз при запуске
-dummy_gpu_function()
+def _bg_init():
+    """Background startup: load and warm up the generator, then signal readiness."""
+    _load_generator()
+    try:
+        _warmup_generator()
+    except Exception as e:
+        print(f"⚠️ Warmup failed: {e}")
+    _ready.set()
 
-def initialize_generator():
-    """Initialize the SQL Query Generator."""
-    global generator
-    if generator is None:
-        print("Initializing SQL Query Generator...")
+threading.Thread(target=_bg_init, daemon=True).start()
+
+async def _wait_until_ready(timeout: float = 0.1) -> bool:
+    """Wait briefly for background initialization without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _ready.wait, timeout)
+
+# Stream tokens to the UI (default); when disabled, questions go through the batching queue
+STREAM_TOKENS = os.getenv("STREAM_TOKENS", "true").lower() == "true"
+_STREAM_END = object()
+
+# Micro-batching: concurrent questions are coalesced into one padded model call
+MAX_BATCH = int(os.getenv("MAX_BATCH", "4"))
+MAX_WAIT_MS = int(os.getenv("MAX_WAIT_MS", "20"))
+_request_queue = None
+_batch_worker = None
+
+async def _ensure_batch_worker():
+    """Start the batching worker on the running event loop (idempotent)."""
+    global _request_queue, _batch_worker
+    if _batch_worker is None or _batch_worker.done():
+        _request_queue = asyncio.Queue()
+        _batch_worker = asyncio.get_running_loop().create_task(_batch_loop())
+
+async def _batch_loop():
+    """Drain up to MAX_BATCH questions within MAX_WAIT_MS and generate them together."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _request_queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_request_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        questions = [question for question, _ in batch]
         try:
-            dataset_path = os.getenv("DATASET_PATH", "example_dataset.parquet")
-            model_name = os.getenv("MODEL_NAME", "NousResearch/Nous-Hermes-llama-2-7b")
-            use_quantization = os.getenv("USE_QUANTIZATION", "true").lower() == "true"
-            
-            print("Loading dataset schema...")
-            generator = SQLQueryGenerator(
-                dataset_path=dataset_path,
-                model_name=model_name,
-                use_quantization=use_quantization,
-                device_map="auto"
-            )
-            print("Initialization complete!")
-            print("SQL Query Generator initialized successfully!")
-            return "✅ SQL Query Generator initialized successfully!"
+            results = await loop.run_in_executor(None, generator.generate_batch, questions)
         except Exception as e:
-            error_msg = f"❌ Error initializing generator: {str(e)}"
-            print(error_msg)
-            import traceback
-            traceback.print_exc()
-            return error_msg
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        for (_, future), sql_query in zip(batch, results):
+            if not future.done():
+                future.set_result(sql_query)
+
+async def _generate_batched(question: str) -> str:
+    """Queue a question for the batching worker and wait for its SQL."""
+    await _ensure_batch_worker()
+    future = asyncio.get_running_loop().create_future()
+    await _request_queue.put((question, future))
+    return await future
+
+async def initialize_generator():
+    """Report initialization status, retrying if the background load failed."""
+    if not await _wait_until_ready():
+        return LOADING_MESSAGE
+    if generator is None:
+        # Background load failed - retry on demand
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _load_generator)
+        return _init_status
     return "✅ SQL Query Generator already initialized!"
 
-def generate_sql(question, history):
-    """Generate SQL query from natural language question."""
-    global generator
+async def generate_sql(question, history):
+    """Generate SQL query from natural language question, streaming partial output."""
     
     # Initialize history if None or not a list
     if history is None:
@@ -86,10 +165,10 @@ def generate_sql(question, history):
         history = []
     
     # Check if generator is initialized
-    if generator is None:
-        error_msg = "⚠️ Please wait for the model to load. This may take a few minutes on first run."
-        history.append(("", error_msg))
-        return "", history
+    if not await _wait_until_ready() or generator is None:
+        history.append(("", _init_status))
+        yield "", history
+        return
     
     # Validate and clean question input
     if question is None:
@@ -99,29 +178,43 @@ def generate_sql(question, history):
     question = str(question).strip()
     
     if not question:
-        error_msg = "⚠️ Please enter a question."
         # Don't add empty question to history, just return
-        return "", history
+        yield "", history
+        return
     
     try:
         # Generate SQL query
         print(f"Processing question: {question}")
-        sql_query = generator.generate(question)
+        if STREAM_TOKENS:
+            # Show tokens as they are decoded; the last item is the validated SQL
+            history.append((question, ""))
+            loop = asyncio.get_running_loop()
+            stream = generator.generate_stream(question)
+            while True:
+                partial = await loop.run_in_executor(None, next, stream, _STREAM_END)
+                if partial is _STREAM_END:
+                    break
+                sql_query = partial
+                history[-1] = (question, sql_query)
+                yield "", history
+        else:
+            sql_query = await _generate_batched(question)
+            # Update conversation history
+            history.append((question, sql_query))
+            # Return empty string for question input (to clear it) and updated history
+            yield "", history
         print(f"Generated SQL: {sql_query}")
-        
-        # Update conversation history
-        history.append((question, sql_query))
-        
-        # Return empty string for question input (to clear it) and updated history
-        return "", history
     except Exception as e:
         error_msg = f"-- ERROR: {str(e)}"
         print(f"Error generating SQL: {error_msg}")
         import traceback
         traceback.print_exc()
-        # Add error to history
-        history.append((question, error_msg))
-        return "", history
+        # Add error to history (replacing the streaming placeholder)
+        if STREAM_TOKENS:
+            history[-1] = (question, error_msg)
+        else:
+            history.append((question, error_msg))
+        yield "", history
 
 def clear_conversation():
     """Clear conversation history."""
@@ -130,10 +223,9 @@ def clear_conversation():
         generator.clear_history()
     return []
 
-def get_schema_info():
+async def get_schema_info():
     """Get schema information for display."""
-    global generator
-    if generator is None:
+    if not await _wait_until_ready() or generator is None:
         return "⚠️ Please wait for the model to load first."
     
     try:
@@ -224,7 +316,7 @@ with gr.Blocks(css=custom_css, title="SQL Query Generator") as demo:
     - All SQL queries are generated in **English only**
     - All values (city names, categories, etc.) are converted to English from the database
     - Only SELECT queries are allowed (safe operations only)
-    - The model uses 8-bit quantization for efficient memory usage
+    - The model uses 4-bit NF4 quantization for efficient memory usage
     """)
     
     # Event handlers
@@ -240,7 +332,7 @@ with gr.Blocks(css=custom_css, title="SQL Query Generator") as demo:
         show_progress=True
     )
     
-    def handle_submit(question, history):
+    async def handle_submit(question, history):
         """Wrapper to handle submit with proper input validation."""
         # Ensure history is a list
         if history is None:
@@ -248,7 +340,8 @@ with gr.Blocks(css=custom_css, title="SQL Query Generator") as demo:
         # Ensure question is a string
         if question is None:
             question = ""
-        return generate_sql(question, history)
+        async for update in generate_sql(question, history):
+            yield update
     
     submit_btn.click(
         fn=handle_submit,
@@ -270,13 +363,18 @@ with gr.Blocks(css=custom_css, title="SQL Query Generator") as demo:
         show_progress=False
     )
     
-    # Initialize on load (with error handling)
-    demo.load(
-        fn=lambda: initialize_generator(),
-        outputs=gr.Textbox(visible=False),
-        show_progress=True
-    )
+    # Start the batching worker on page load (API calls start it lazily)
+    demo.load(fn=_ensure_batch_worker)
+
+# Allow several users at once instead of serializing every event.
+# A bounded queue sheds load instead of piling up requests; api_open=False
+# forces API clients through the queue too (gradio_client already uses it)
+demo.queue(
+    default_concurrency_limit=int(os.getenv("CONCURRENCY_LIMIT", "4")),
+    max_size=int(os.getenv("QUEUE_MAX_SIZE", "64")),
+    api_open=False
+)
 
 if __name__ == "__main__":
-    demo.launch(server_name="0.0.0.0", server_port=7860)
+    demo.launch(server_name="0.0.0.0", server_port=7860, max_threads=40)
 
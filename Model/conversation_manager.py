@@ -1,8 +1,51 @@
 """
 Conversation History Manager for context-aware SQL generation.
 """
-from typing import List, Dict, Optional
-from datetime import datetime
+import re
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, Optional
+import time
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional
+    ahocorasick = None
+
+
+FOLLOW_UP_INDICATORS = (
+    'now show me',
+    'now show',
+    'show me',
+    'also show',
+    'and show',
+    'then show',
+    'next show',
+    'also',
+    'and',
+    'then',
+    'next',
+    'filter',
+    'refine',
+    'narrow',
+    'expand'
+)
+
+# All indicators are matched in a single pass over the input: an Aho-Corasick
+# automaton when pyahocorasick is installed, otherwise one compiled alternation
+if ahocorasick is not None:
+    _FOLLOWUP_AC = ahocorasick.Automaton()
+    for _indicator in FOLLOW_UP_INDICATORS:
+        _FOLLOWUP_AC.add_word(_indicator, _indicator)
+    _FOLLOWUP_AC.make_automaton()
+    
+    def _contains_follow_up(text: str) -> bool:
+        return next(_FOLLOWUP_AC.iter(text), None) is not None
+else:
+    _FOLLOWUP_RE = re.compile('|'.join(map(re.escape, FOLLOW_UP_INDICATORS)))
+    
+    def _contains_follow_up(text: str) -> bool:
+        return _FOLLOWUP_RE.search(text) is not None
 
 
 class ConversationManager:
@@ -16,10 +59,15 @@ class ConversationManager:
             max_history: Maximum number of conversation turns to keep
         """
         self.max_history = max_history
-        self.history: List[Dict] = []
-        self.last_query: Optional[str] = None
+        # Bounded deque drops the oldest turn in O(1) once max_history is reached
+        self.history: Deque[Dict] = deque(maxlen=max_history)
         self.last_sql: Optional[str] = None
     
+    @property
+    def last_query(self) -> Optional[str]:
+        """Alias of last_sql, kept for backwards compatibility."""
+        return self.last_sql
+    
     def add_turn(self, user_input: str, sql_query: str, context: Optional[Dict] = None):
         """
         Add a conversation turn to history.
@@ -30,19 +78,14 @@ class ConversationManager:
             context: Optional additional context
         """
         turn = {
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': time.monotonic(),
             'user_input': user_input,
             'sql_query': sql_query,
             'context': context or {}
         }
         
         self.history.append(turn)
-        self.last_query = sql_query
         self.last_sql = sql_query
-        
-        # Keep only recent history
-        if len(self.history) > self.max_history:
-            self.history = self.history[-self.max_history:]
     
     def is_follow_up(self, user_input: str) -> bool:
         """
@@ -54,29 +97,11 @@ class ConversationManager:
         Returns:
             True if input appears to be a follow-up
         """
-        if not self.last_query:
+        if not self.last_sql:
             return False
         
-        follow_up_indicators = [
-            'now show me',
-            'now show',
-            'show me',
-            'also show',
-            'and show',
-            'then show',
-            'next show',
-            'also',
-            'and',
-            'then',
-            'next',
-            'filter',
-            'refine',
-            'narrow',
-            'expand'
-        ]
-        
         input_lower = user_input.lower().strip()
-        return any(indicator in input_lower for indicator in follow_up_indicators)
+        return _contains_follow_up(input_lower)
     
     def get_context_prompt(self) -> str:
         """
@@ -91,7 +116,7 @@ class ConversationManager:
         context_parts = ["Previous conversation:"]
         
         # Include last 2-3 turns for context
-        recent_turns = self.history[-3:]
+        recent_turns = islice(self.history, max(0, len(self.history) - 3), None)
         for i, turn in enumerate(recent_turns, 1):
             context_parts.append(f"\nTurn {i}:")
             context_parts.append(f"  User: {turn['user_input']}")
@@ -105,7 +130,6 @@ class ConversationManager:
     
     def clear_history(self):
         """Clear conversation history."""
-        self.history = []
-        self.last_query = None
+        self.history.clear()
         self.last_sql = None
 
@@ -25,7 +25,7 @@ def main():
         generator = SQLQueryGenerator(
             dataset_path="example_dataset.parquet",
             model_name="NousResearch/Nous-Hermes-llama-2-7b",
-            use_quantization=True,  # Use 8-bit quantization to save memory
+            use_quantization=True,  # Use 4-bit NF4 quantization to save memory
             device_map="auto"
         )
         
@@ -34,7 +34,21 @@ def main():
     parser.add_argument(
         "--no-quantization",
         action="store_true",
-        help="Disable 8-bit quantization (uses more memory but may be faster)"
+        help="Disable quantization (uses more memory but may be faster)"
+    )
+    
+    parser.add_argument(
+        "--quant-mode",
+        type=str,
+        choices=["nf4", "int8", "fp16", "awq", "gptq"],
+        default="nf4",
+        help="Quantization scheme: nf4 (4-bit), int8, fp16, or awq/gptq for a pre-quantized --model (default: nf4)"
+    )
+    
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the model with torch.compile (GPU only, slower startup, faster decoding)"
     )
     
     parser.add_argument(
@@ -59,8 +73,15 @@ def main():
             dataset_path=args.dataset,
             model_name=args.model,
             use_quantization=not args.no_quantization,
-            device_map="auto"
+            device_map="auto",
+            quant_mode=args.quant_mode,
+            compile_model=args.compile or None
         )
+        if generator.compiled:
+            # Compile the decode step and size the static cache now; prefill may still
+            # recompile for new prompt lengths
+            print("Warming up compiled model...")
+            generator.warmup()
         print("Generator initialized successfully!\n")
     except Exception as e:
         print(f"Error initializing generator: {str(e)}")
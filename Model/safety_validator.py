@@ -2,31 +2,77 @@
 Safety Validator for SQL queries - ensures only safe SELECT queries are generated.
 """
 import re
+from functools import lru_cache
 import sqlparse
 from sqlparse.sql import Statement
 from sqlparse.tokens import Keyword, DML
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+
+
+# Dangerous SQL keywords that should never appear
+DANGEROUS_KEYWORDS = frozenset({
+    'DROP', 'DELETE', 'UPDATE', 'INSERT', 'ALTER', 
+    'TRUNCATE', 'CREATE', 'EXEC', 'EXECUTE', 'GRANT',
+    'REVOKE', 'MERGE', 'REPLACE'
+})
+
+# SQL injection patterns rejected in natural language input
+DANGEROUS_INPUT_PATTERNS = (
+    '; DROP',
+    '; DELETE',
+    '; UPDATE',
+    '; INSERT',
+    'UNION SELECT',
+    '1=1',
+    'OR 1=1',
+    '--',
+    '/*',
+    '*/'
+)
+
+# Patterns are compiled once at import instead of on every validation call
+_COMMENT_RE = re.compile(r'^\s*--.*?$', re.MULTILINE)
+_BLOCK_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_INJECTION_RE = re.compile(
+    '|'.join(map(re.escape, DANGEROUS_INPUT_PATTERNS)),
+    re.IGNORECASE
+)
+
+
+@lru_cache(maxsize=256)
+def _check_parsed_query(query_clean: str) -> Tuple[bool, str]:
+    """Parse a cleaned query and check its tokens; identical model outputs skip reparsing."""
+    try:
+        parsed = sqlparse.parse(query_clean)
+        if not parsed:
+            return False, "Invalid SQL syntax"
+        
+        # Check each statement
+        for statement in parsed:
+            is_safe, keyword = SafetyValidator._is_safe_statement(statement)
+            if not is_safe:
+                return False, f"Query contains dangerous keywords: {keyword}"
+                
+    except Exception as e:
+        return False, f"SQL parsing error: {str(e)}"
+    
+    return True, ""
 
 
 class SafetyValidator:
     """Validates SQL queries to ensure they are safe SELECT-only queries."""
     
-    # Dangerous SQL keywords that should never appear
-    DANGEROUS_KEYWORDS = {
-        'DROP', 'DELETE', 'UPDATE', 'INSERT', 'ALTER', 
-        'TRUNCATE', 'CREATE', 'EXEC', 'EXECUTE', 'GRANT',
-        'REVOKE', 'MERGE', 'REPLACE'
-    }
+    DANGEROUS_KEYWORDS = DANGEROUS_KEYWORDS
     
     # Allowed SQL keywords (only SELECT-related)
-    ALLOWED_KEYWORDS = {
+    ALLOWED_KEYWORDS = frozenset({
         'SELECT', 'FROM', 'WHERE', 'GROUP', 'BY', 'ORDER', 
         'HAVING', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL',
         'OUTER', 'ON', 'AS', 'AND', 'OR', 'NOT', 'IN', 
         'LIKE', 'BETWEEN', 'IS', 'NULL', 'DISTINCT', 'COUNT',
         'SUM', 'AVG', 'MAX', 'MIN', 'LIMIT', 'OFFSET', 'UNION',
         'ALL', 'CASE', 'WHEN', 'THEN', 'ELSE', 'END', 'ASC', 'DESC'
-    }
+    })
     
     def validate(self, query: str) -> Tuple[bool, str]:
         """
@@ -44,8 +90,8 @@ class SafetyValidator:
         # Normalize query - remove leading comments and whitespace
         # Remove SQL comments (-- and /* */) but preserve the query structure
         # First, remove full-line comments that might appear before SELECT
-        query_clean = re.sub(r'^\s*--.*?$', '', query, flags=re.MULTILINE)  # Remove -- comments at start of lines
-        query_clean = re.sub(r'/\*.*?\*/', '', query_clean, flags=re.DOTALL)  # Remove /* */ comments
+        query_clean = _COMMENT_RE.sub('', query)  # Remove -- comments at start of lines
+        query_clean = _BLOCK_COMMENT_RE.sub('', query_clean)  # Remove /* */ comments
         query_clean = query_clean.strip()
         query_upper = query_clean.upper()
         
@@ -53,43 +99,31 @@ class SafetyValidator:
         if not query_upper.startswith('SELECT'):
             return False, "Only SELECT queries are allowed"
         
-        # Parse SQL to check for dangerous keywords (use cleaned query)
-        try:
-            parsed = sqlparse.parse(query_clean)
-            if not parsed:
-                return False, "Invalid SQL syntax"
-            
-            # Check each statement
-            for statement in parsed:
-                if not self._is_safe_statement(statement):
-                    return False, "Query contains unsafe operations"
-                    
-        except Exception as e:
-            return False, f"SQL parsing error: {str(e)}"
-        
-        # Check for dangerous keywords in the query
-        query_words = set(query_upper.split())
-        dangerous_found = query_words.intersection(self.DANGEROUS_KEYWORDS)
+        # Parse SQL and check keyword tokens (use cleaned query)
+        return _check_parsed_query(query_clean)
+    
+    @staticmethod
+    def _is_safe_statement(statement: Statement) -> Tuple[bool, Optional[str]]:
+        """
+        Check if a parsed SQL statement is safe in a single pass over its tokens.
         
-        if dangerous_found:
-            return False, f"Query contains dangerous keywords: {', '.join(dangerous_found)}"
+        Only keyword tokens are inspected, so words inside string literals
+        (e.g. name = 'DROP TABLE') are not flagged.
         
-        return True, ""
-    
-    def _is_safe_statement(self, statement: Statement) -> bool:
-        """Check if a parsed SQL statement is safe."""
-        # Check token types
+        Returns:
+            Tuple of (is_safe, offending_keyword)
+        """
         for token in statement.flatten():
             if token.ttype is DML:
                 # Only SELECT is allowed
                 if token.value.upper() != 'SELECT':
-                    return False
-            elif token.ttype is Keyword:
+                    return False, token.value.upper()
+            elif token.ttype in Keyword:  # Includes DDL/DCL subtypes such as DROP, GRANT
                 keyword = token.value.upper()
-                if keyword in self.DANGEROUS_KEYWORDS:
-                    return False
+                if keyword in DANGEROUS_KEYWORDS:
+                    return False, keyword
         
-        return True
+        return True, None
     
     def sanitize_input(self, user_input: str) -> str:
         """
@@ -101,25 +135,10 @@ class SafetyValidator:
         Returns:
             Sanitized input string
         """
-        # Remove or escape potentially dangerous characters
         # For natural language, we mainly check for obvious SQL injection patterns
-        dangerous_patterns = [
-            '; DROP',
-            '; DELETE',
-            '; UPDATE',
-            '; INSERT',
-            'UNION SELECT',
-            '1=1',
-            'OR 1=1',
-            '--',
-            '/*',
-            '*/'
-        ]
-        
-        input_upper = user_input.upper()
-        for pattern in dangerous_patterns:
-            if pattern in input_upper:
-                raise ValueError(f"Input contains potentially dangerous pattern: {pattern}")
+        match = _INJECTION_RE.search(user_input)
+        if match:
+            raise ValueError(f"Input contains potentially dangerous pattern: {match.group(0).upper()}")
         
         return user_input.strip()
 
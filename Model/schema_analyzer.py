@@ -1,10 +1,20 @@
 """
 Schema Analyzer for extracting table and column information from parquet dataset.
 """
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import json
+import os
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, json is used as a fallback
+    orjson = None
+
+# Bump when the sidecar payload layout changes so stale caches are ignored
+_CACHE_VERSION = 2
 
 
 class SchemaAnalyzer:
@@ -23,45 +33,141 @@ class SchemaAnalyzer:
         self.columns = None
         self.column_types = None
         self.sample_data = None
+        # Derived once per analyze() - the schema is fixed for the life of the process
+        self._example_values: Dict[str, List[str]] = {}
+        self._schema_prompt: Optional[str] = None
+        self._schema_json: Optional[str] = None
         
     def analyze(self) -> Dict:
         """
         Analyze the parquet file and extract schema information.
         
+        Only the parquet footer and the first batch of rows are read, and the
+        result is cached in a JSON sidecar next to the dataset.
+        
         Returns:
             Dictionary containing schema information
         """
+        self._schema_json = None
+        
+        cached = self._load_cache()
+        if cached is not None:
+            self._apply_schema_info(cached)
+            self._schema_prompt = self._build_schema_prompt()
+            return self.schema_info
+        
         try:
-            # Read parquet file
-            df = pd.read_parquet(self.dataset_path)
+            pf = pq.ParquetFile(self.dataset_path)
             
             # Extract table name (from filename or default)
             self.table_name = self._extract_table_name()
             
-            # Extract column information
-            self.columns = list(df.columns)
-            self.column_types = {col: str(dtype) for col, dtype in df.dtypes.items()}
+            # Extract column information from the footer (no data pages read)
+            self.columns = pf.schema_arrow.names
+            self.column_types = {field.name: str(field.type) for field in pf.schema_arrow}
             
             # Get sample data for understanding data patterns
-            self.sample_data = df.head(10).to_dict('records')
+            first_batch = next(pf.iter_batches(batch_size=10), None)
+            self.sample_data = first_batch.to_pylist() if first_batch is not None else []
+            self._example_values = self._compute_example_values(first_batch)
             
             # Build schema info
             self.schema_info = {
                 'table_name': self.table_name,
                 'columns': self.columns,
                 'column_types': self.column_types,
-                'row_count': len(df),
+                'row_count': pf.metadata.num_rows,
                 'sample_data': self.sample_data[:5]  # First 5 rows for context
             }
             
-            return self.schema_info
-            
         except Exception as e:
             raise ValueError(f"Error analyzing dataset: {str(e)}")
+        
+        self._save_cache()
+        self._schema_prompt = self._build_schema_prompt()
+        return self.schema_info
+    
+    @staticmethod
+    def _compute_example_values(batch: Optional[pa.RecordBatch]) -> Dict[str, List[str]]:
+        """Collect up to 5 distinct non-empty example values per column using Arrow kernels."""
+        if batch is None:
+            return {}
+        
+        example_values = {}
+        for name, column in zip(batch.schema.names, batch.columns):
+            examples = SchemaAnalyzer._column_examples(column)
+            if examples:
+                example_values[name] = examples
+        return example_values
+    
+    @staticmethod
+    def _column_examples(column: pa.Array, limit: int = 5) -> List[str]:
+        """Distinct non-empty example values of one column, as strings."""
+        # pc.unique has no kernels for list/struct/map columns
+        if not pa.types.is_nested(column.type):
+            try:
+                unique_values = pc.unique(pc.drop_null(column)).to_pylist()
+                return [str(value) for value in unique_values if str(value).strip()][:limit]
+            except (pa.ArrowException, ValueError):
+                pass
+        
+        examples = []
+        for value in column.to_pylist():
+            text = str(value) if value is not None else ''
+            if text.strip() and text not in examples:
+                examples.append(text)
+                if len(examples) == limit:
+                    break
+        return examples
+    
+    def _cache_path(self) -> str:
+        """Path of the JSON sidecar holding the cached schema info."""
+        return f"{self.dataset_path}.schema.json"
+    
+    def _cache_key(self) -> Dict:
+        """Key identifying the dataset version the cache was built from."""
+        return {
+            'path': os.path.abspath(self.dataset_path),
+            'mtime': os.path.getmtime(self.dataset_path),
+            'version': _CACHE_VERSION
+        }
+    
+    def _load_cache(self) -> Optional[Dict]:
+        """Return the cached payload if it matches the current dataset, else None."""
+        try:
+            with open(self._cache_path(), 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('key') != self._cache_key():
+                return None
+            return cached
+        except (OSError, ValueError):
+            return None
+    
+    def _save_cache(self):
+        """Persist schema info to the sidecar; failures are not fatal."""
+        payload = {
+            'key': self._cache_key(),
+            'schema_info': self.schema_info,
+            'sample_data': self.sample_data,
+            'example_values': self._example_values
+        }
+        try:
+            with open(self._cache_path(), 'w', encoding='utf-8') as f:
+                json.dump(payload, f, default=str)
+        except (OSError, TypeError, ValueError):
+            pass
+    
+    def _apply_schema_info(self, cached: Dict):
+        """Restore analyzer state from a cached payload."""
+        self.schema_info = cached['schema_info']
+        self.table_name = self.schema_info['table_name']
+        self.columns = self.schema_info['columns']
+        self.column_types = self.schema_info['column_types']
+        self.sample_data = cached['sample_data']
+        self._example_values = cached['example_values']
     
     def _extract_table_name(self) -> str:
         """Extract table name from file path or use default."""
-        import os
         filename = os.path.basename(self.dataset_path)
         # Remove extension and use as table name
         table_name = os.path.splitext(filename)[0]
@@ -71,14 +177,19 @@ class SchemaAnalyzer:
     
     def get_schema_prompt(self) -> str:
         """
-        Generate a schema description for the model prompt.
+        Get the schema description for the model prompt.
+        
+        The string is built once by analyze() and reused for every prompt.
         
         Returns:
             Formatted schema description string
         """
         if not self.schema_info:
             self.analyze()
-        
+        return self._schema_prompt
+    
+    def _build_schema_prompt(self) -> str:
+        """Render the schema description from the analyzed schema info."""
         schema_parts = [
             f"TABLE: {self.schema_info['table_name']}",
             f"COLUMNS: {', '.join(self.schema_info['columns'])}",
@@ -93,21 +204,9 @@ class SchemaAnalyzer:
             schema_parts.append("")
             schema_parts.append("EXAMPLE VALUES (use these exact English values in queries):")
             
-            # Extract unique example values for each column
-            example_values = {}
-            for record in self.sample_data[:10]:  # Use up to 10 sample records
-                for col, value in record.items():
-                    if value is not None and str(value).strip():
-                        if col not in example_values:
-                            example_values[col] = set()
-                        example_values[col].add(str(value))
-            
             # Show examples for key columns (especially city, date columns)
-            for col in self.columns:
-                if col in example_values and len(example_values[col]) > 0:
-                    examples = list(example_values[col])[:5]  # Show up to 5 examples
-                    if examples:
-                        schema_parts.append(f"  - {col}: {', '.join(examples)}")
+            for col, examples in self._example_values.items():
+                schema_parts.append(f"  - {col}: {', '.join(examples)}")
         
         return "\n".join(schema_parts)
     
@@ -115,5 +214,10 @@ class SchemaAnalyzer:
         """Get schema as JSON string."""
         if not self.schema_info:
             self.analyze()
-        return json.dumps(self.schema_info, indent=2)
+        if self._schema_json is None:
+            if orjson is not None:
+                self._schema_json = orjson.dumps(self.schema_info, option=orjson.OPT_INDENT_2).decode()
+            else:
+                self._schema_json = json.dumps(self.schema_info, indent=2)
+        return self._schema_json
 
@@ -2,14 +2,21 @@
 Main SQL Query Generator using Nous-Hermes-Llama2-7b model (open source, fine-tuned for instruction following).
 """
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-from typing import Optional, Dict
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from typing import Optional, Dict, Iterator, List, Tuple, Union
+import copy
+import gc
+from contextlib import nullcontext
+from functools import lru_cache
+import importlib.util
+import logging
 import re
 import os
+import threading
 from dotenv import load_dotenv
 
 from schema_analyzer import SchemaAnalyzer
-from safety_validator import SafetyValidator
+from safety_validator import SafetyValidator, DANGEROUS_KEYWORDS
 from conversation_manager import ConversationManager
 
 # Load environment variables from .env file (if it exists)
@@ -20,6 +27,112 @@ except Exception:
     # Token can also be set via environment variable directly
     pass
 
+# Per-request diagnostics go through logging so they cost nothing unless DEBUG is enabled
+logger = logging.getLogger(__name__)
+
+# Statement keywords banned at decode time. REPLACE is also a string function,
+# and MERGE/EXEC are common inside identifiers (merged_at), so those are left
+# to SafetyValidator, which rejects the statement forms anyway
+BANNED_STATEMENT_KEYWORDS = DANGEROUS_KEYWORDS - {'REPLACE', 'MERGE', 'EXEC'}
+
+# Greetings and small talk that are never database questions
+GREETING_PHRASES = (
+    'привет', 'hello', 'hi', 'hey', 'здравствуй', 'добрый',
+    'как дела', 'how are you', 'как поживаешь', 'что нового',
+    'спасибо', 'thanks', 'thank you', 'благодарю',
+    'пока', 'bye', 'до свидания', 'goodbye',
+    'как тебя зовут', 'what is your name', 'who are you',
+    'что ты умеешь', 'what can you do', 'что ты делаешь',
+    'помощь', 'help', 'помоги', 'help me'
+)
+
+# SQL/database related keywords (and word stems) that indicate a real query
+SQL_QUERY_KEYWORDS = (
+    'select', 'show', 'find', 'get', 'count', 'sum', 'avg', 'max', 'min',
+    'where', 'from', 'table', 'database', 'query',
+    'транзакц', 'transaction', 'данные', 'data', 'записи', 'records',
+    'сколько', 'how many', 'посчитай', 'calculate',
+    'покажи', 'show me', 'выведи', 'display',
+    'найди', 'ищи', 'search', 'filter',
+    'в', 'in', 'из', 'от',
+    'дата', 'date', 'время', 'time', 'год', 'year', 'месяц', 'month',
+    'город', 'city', 'сумма', 'amount', 'категория', 'category',
+    'больше', 'more than', 'greater', 'меньше', 'less than',
+    'между', 'between', 'и', 'and', 'или', 'or'
+)
+
+# One regex pass per check instead of a substring scan per phrase. Greetings match
+# whole words only ('hi' must not match 'which'); keywords stay substring matches
+# so stems like 'транзакц' still hit
+_GREETING_RE = re.compile(r'\b(?:' + '|'.join(map(re.escape, GREETING_PHRASES)) + r')\b', re.IGNORECASE)
+_SQL_KEYWORD_RE = re.compile('|'.join(map(re.escape, SQL_QUERY_KEYWORDS)), re.IGNORECASE)
+
+# Reply for greetings and other non-database input
+NOT_SQL_RESPONSE = (
+    "-- This is not a SQL query request. Please ask questions about the database, such as:\n"
+    "--   - 'Show me all transactions above $1000'\n"
+    "--   - 'Count transactions in Almaty in November 2023'\n"
+    "--   - 'Find transactions between dates'\n"
+    "--   etc."
+)
+
+
+@lru_cache(maxsize=1024)
+def _is_sql_related_text(text: str) -> bool:
+    """Classify normalized (stripped, lowercased) input; cached since chat users repeat greetings."""
+    # Check for greetings
+    if _GREETING_RE.search(text):
+        return False
+    
+    # Inputs with SQL-related keywords are queries; short inputs without any
+    # are not, anything longer is assumed to be a query
+    return bool(_SQL_KEYWORD_RE.search(text)) or len(text.split()) > 3
+
+# Patterns used by _extract_sql, compiled once at import instead of on every response
+_SQL_QUERY_RE = re.compile(
+    r'SQL QUERY:\s*(.*?)(?:\n\n|\n[A-Z]|USER QUESTION:|SQL QUERY:|$)',
+    re.DOTALL | re.IGNORECASE
+)
+_SELECT_BLOCK_RE = re.compile(
+    r'(SELECT\s+.*?)(?:\n\n|\n(?:Please|Note|Explanation|This|The query|USER QUESTION|SQL QUERY)|USER QUESTION:|SQL QUERY:|$)',
+    re.DOTALL | re.IGNORECASE
+)
+_SELECT_STATEMENT_RE = re.compile(r'(SELECT.*?)(?:;|USER QUESTION:|SQL QUERY:|$|\n\n)', re.DOTALL | re.IGNORECASE)
+_LAST_RESORT_CUT_RE = re.compile(r'USER QUESTION:|SQL QUERY:|\n\n|\n(?:Please|Note|Explanation)', re.IGNORECASE)
+_STRIP_TOKENS_RE = re.compile(r'```(?:sql)?\s*|\[/?INST\]\s*|</?s>\s*', re.IGNORECASE)
+_EXPLANATION_RE = re.compile(
+    r'(.*?)(?:Please|Note|Explanation|This query|The query|This will|This returns)',
+    re.DOTALL | re.IGNORECASE
+)
+_TRAILING_COMMENT_RE = re.compile(r'(.*?)(?:--.*$)', re.DOTALL | re.IGNORECASE)
+_INST_TAIL_RE = re.compile(r'\[/INST\].*$', re.IGNORECASE)
+_EXPLANATION_LINE_RE = re.compile(r'^(Please|Note|Explanation|This|The query|This will|This returns)', re.IGNORECASE)
+_PROMPT_MARKER_TAIL_RE = re.compile(r'(?:USER QUESTION:|SQL QUERY:).*$', re.IGNORECASE | re.DOTALL)
+_PROMPT_MARKER_RE = re.compile(r'USER QUESTION:|SQL QUERY:', re.IGNORECASE)
+
+# Decoding stops as soon as the output contains one of these: the query is complete
+# or the model has started a new prompt turn that _extract_sql would cut anyway
+STOP_STRINGS = (';', 'USER QUESTION:', 'SQL QUERY:', '[INST]', '[/INST]')
+
+
+class StopOnSubstrings(StoppingCriteria):
+    """Stop each sequence once its last few generated tokens contain a stop string."""
+    
+    def __init__(self, tokenizer, prompt_length: int, stop_strings=STOP_STRINGS, lookback: int = 8):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length  # Prompt tokens are never checked
+        self.stop_strings = stop_strings
+        self.lookback = lookback
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        start = max(self.prompt_length, input_ids.shape[1] - self.lookback)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+        return torch.tensor(
+            [any(stop in tail for stop in self.stop_strings) for tail in tails],
+            dtype=torch.bool,
+            device=input_ids.device
+        )
+
 
 class SQLQueryGenerator:
     """Main class for generating SQL queries from natural language."""
@@ -29,7 +142,10 @@ class SQLQueryGenerator:
         dataset_path: str,
         model_name: str = "NousResearch/Nous-Hermes-llama-2-7b",
         use_quantization: bool = True,
-        device_map: str = "auto"
+        device_map: str = "auto",
+        low_cpu_mem_usage: bool = True,
+        quant_mode: str = "nf4",
+        compile_model: Optional[bool] = None
     ):
         """
         Initialize SQL Query Generator.
@@ -37,8 +153,16 @@ class SQLQueryGenerator:
         Args:
             dataset_path: Path to the parquet dataset file
             model_name: Hugging Face model name or local path
-            use_quantization: Whether to use 8-bit quantization for memory efficiency
+            use_quantization: Whether to use quantization for memory efficiency
             device_map: Device mapping strategy
+            low_cpu_mem_usage: Initialize weights on the meta device and load them
+                straight to their target device instead of materializing on CPU first
+            quant_mode: Quantization scheme when use_quantization is enabled:
+                "nf4" (4-bit weight-only), "int8" (LLM.int8) or "fp16" (none);
+                "awq" / "gptq" load a pre-quantized INT4 checkpoint given as model_name
+            compile_model: Compile the forward pass with torch.compile and a static KV
+                cache (GPU only, slower startup; call warmup() before serving).
+                Defaults to the TORCH_COMPILE environment variable
         """
         self.dataset_path = dataset_path
         self.model_name = model_name
@@ -47,6 +171,8 @@ class SQLQueryGenerator:
         print("Loading schema analyzer...")
         self.schema_analyzer = SchemaAnalyzer(dataset_path)
         self.schema_info = self.schema_analyzer.analyze()
+        self._prompt_prefix: Optional[str] = None
+        self._chat_wrapper: Optional[Tuple[str, str]] = None
         
         print("Initializing safety validator...")
         self.safety_validator = SafetyValidator()
@@ -58,12 +184,51 @@ class SQLQueryGenerator:
         print(f"Loading model: {model_name}...")
         self.tokenizer = None
         self.model = None
-        self.pipeline = None
-        self._load_model(use_quantization, device_map)
+        self._load_model(use_quantization, device_map, low_cpu_mem_usage, quant_mode)
+        
+        # Token sequences the decoder may never emit (SELECT-only constraint)
+        self.bad_words_ids = self._build_bad_words_ids()
+        
+        # Decoding arguments that are the same for every request
+        # Use greedy decoding (do_sample=False) for faster and more deterministic generation
+        # This avoids the temperature/top_p warning and is faster than sampling
+        self._static_generation_kwargs = {
+            "do_sample": False,  # Greedy decoding for speed (faster than sampling)
+            "num_beams": 1,
+            "num_return_sequences": 1,
+            "pad_token_id": self.tokenizer.eos_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id,
+            # Never emit dangerous SQL keywords; generate() rejects an empty list
+            "bad_words_ids": self.bad_words_ids or None,
+            "use_cache": True  # Enable KV cache for faster generation
+        }
+        
+        # Optional: compile the decode step (compile_model=True or TORCH_COMPILE=1)
+        if compile_model is None:
+            compile_model = os.getenv("TORCH_COMPILE") == "1"
+        self.compiled = False
+        if compile_model:
+            self._compile_model()
+        # A compiled static-cache graph is shared and mutated by every generate call,
+        # so concurrent requests (Gradio runs several, streaming uses threads) are
+        # serialized; eager generate calls may overlap
+        self._generate_lock = threading.Lock() if self.compiled else nullcontext()
+        
+        # Precompute the KV cache of the static instructions + schema prompt prefix
+        self.prefix_ids = None
+        self.prefix_cache = None
+        self.prefix_text = None
+        self._build_prefix_cache()
         
         print("SQL Query Generator initialized successfully!")
     
-    def _load_model(self, use_quantization: bool, device_map: str):
+    def _load_model(
+        self,
+        use_quantization: bool,
+        device_map: str,
+        low_cpu_mem_usage: bool = True,
+        quant_mode: str = "nf4"
+    ):
         """Load the Nous-Hermes-Llama2-7b model and tokenizer."""
         try:
             # Get Hugging Face token from environment
@@ -75,7 +240,7 @@ class SQLQueryGenerator:
                 print(f"Using Hugging Face token (length: {len(hf_token)})")
             
             # Prepare tokenizer kwargs
-            tokenizer_kwargs = {"trust_remote_code": True}
+            tokenizer_kwargs = {"trust_remote_code": True, "use_fast": True}
             if hf_token:
                 tokenizer_kwargs["token"] = hf_token
             
@@ -83,17 +248,25 @@ class SQLQueryGenerator:
                 self.model_name,
                 **tokenizer_kwargs
             )
+            if not self.tokenizer.is_fast:
+                print("Warning: No fast (Rust) tokenizer available for this model; tokenization will be slower.")
             
             # Set pad token if not set
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Decoder-only models must be left-padded for batched generation
+            self.tokenizer.padding_side = "left"
             
             # Load model with optional quantization
+            model_dtype = self._pick_dtype()
             model_kwargs = {
                 "trust_remote_code": True,
                 "device_map": device_map,
-                "dtype": torch.float16 if torch.cuda.is_available() else torch.float32  # Use dtype instead of deprecated torch_dtype
+                "low_cpu_mem_usage": low_cpu_mem_usage,  # Meta-device init, weights streamed to their final device
+                "dtype": model_dtype,  # Use dtype instead of deprecated torch_dtype
+                "attn_implementation": self._select_attn_implementation(model_dtype, device_map)
             }
+            print(f"Using attention implementation: {model_kwargs['attn_implementation']}")
             
             # Add token if available
             if hf_token:
@@ -102,34 +275,61 @@ class SQLQueryGenerator:
             # Track if we're using CPU mode
             using_cpu_mode = False
             
+            quant_mode = quant_mode.lower()
+            if quant_mode not in ("nf4", "int8", "fp16", "awq", "gptq"):
+                raise ValueError(
+                    f"Unknown quant_mode '{quant_mode}', expected 'nf4', 'int8', 'fp16', 'awq' or 'gptq'"
+                )
+            
+            if quant_mode in ("awq", "gptq"):
+                # Pre-quantized checkpoint (e.g. a TheBloke/*-AWQ repo): transformers reads the
+                # quantization_config from its config.json and uses fused INT4 x FP16 kernels,
+                # so no bitsandbytes config and no CPU offload are needed
+                if quant_mode == "awq":
+                    model_kwargs["dtype"] = torch.float16  # AWQ kernels run in fp16
+                print(f"Loading pre-quantized {quant_mode.upper()} checkpoint...")
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    **model_kwargs
+                )
+                if getattr(self.model.config, "quantization_config", None) is None:
+                    print(f"Warning: {self.model_name} has no quantization_config; it is not a pre-quantized {quant_mode.upper()} checkpoint.")
             # Try to load with quantization if requested and GPU is available
-            if use_quantization and torch.cuda.is_available():
-                try:
-                    from transformers import BitsAndBytesConfig
-                    quantization_config = BitsAndBytesConfig(
-                        load_in_8bit=True,
-                        llm_int8_threshold=6.0,
-                        llm_int8_enable_fp32_cpu_offload=True  # Enable CPU offloading for models that don't fit in GPU RAM
-                    )
-                    model_kwargs["quantization_config"] = quantization_config
-                    # Use balanced device_map for CPU offloading
-                    if device_map == "auto":
-                        model_kwargs["device_map"] = "balanced"  # Better for CPU offloading
-                    
-                    print("Attempting to load model with 8-bit quantization...")
-                    self.model = AutoModelForCausalLM.from_pretrained(
-                        self.model_name,
-                        **model_kwargs
-                    )
-                    print("Model loaded successfully with quantization!")
-                except Exception as quant_error:
+            elif use_quantization and quant_mode != "fp16" and torch.cuda.is_available():
+                # NF4 falls back to LLM.int8 before giving up on the GPU
+                attempt_modes = ["nf4", "int8"] if quant_mode == "nf4" else [quant_mode]
+                quant_error = None
+                for attempt_mode in attempt_modes:
+                    attempt_kwargs = {
+                        **model_kwargs,
+                        **self._quantization_kwargs(attempt_mode, model_dtype, device_map)
+                    }
+                    try:
+                        print(f"Attempting to load model with {attempt_mode} quantization...")
+                        self.model = AutoModelForCausalLM.from_pretrained(
+                            self.model_name,
+                            **attempt_kwargs
+                        )
+                        model_kwargs = attempt_kwargs
+                        print("Model loaded successfully with quantization!")
+                        break
+                    except Exception as e:
+                        print(f"Warning: {attempt_mode} quantization failed: {str(e)}")
+                        # The traceback frames hold the partly loaded weights; drop them
+                        # and free their GPU memory, or an OOM in NF4 repeats in the retry
+                        quant_error = e.with_traceback(None)
+                        del e
+                        gc.collect()
+                        torch.cuda.empty_cache()
+                
+                if self.model is None:
                     error_str = str(quant_error)
                     if "GPU RAM" in error_str or "quantized model" in error_str or "CPU or the disk" in error_str:
                         print("Warning: Quantization failed due to insufficient GPU RAM. Falling back to CPU mode...")
-                        # Remove quantization config and retry on CPU
-                        model_kwargs.pop("quantization_config", None)
+                        # Retry on CPU without quantization
                         model_kwargs["device_map"] = "cpu"
                         model_kwargs["dtype"] = torch.float32
+                        model_kwargs["attn_implementation"] = "sdpa"  # FlashAttention is GPU-only
                         using_cpu_mode = True
                         self.model = AutoModelForCausalLM.from_pretrained(
                             self.model_name,
@@ -137,7 +337,7 @@ class SQLQueryGenerator:
                         )
                         print("Model loaded successfully on CPU (quantization disabled).")
                     else:
-                        raise
+                        raise quant_error
             else:
                 # No quantization - load normally
                 if not torch.cuda.is_available() or device_map == "cpu":
@@ -147,28 +347,15 @@ class SQLQueryGenerator:
                     **model_kwargs
                 )
             
-            # Create pipeline
-            # When using device_map (accelerate), don't specify device parameter
-            # The model is already on the correct device(s) via device_map
-            # Check if model was loaded with device_map (accelerate)
-            model_has_device_map = hasattr(self.model, 'hf_device_map') or model_kwargs.get("device_map") not in [None, "cpu"]
-            
-            if model_has_device_map:
-                # Don't specify device when using accelerate/device_map
-                self.pipeline = pipeline(
-                    "text-generation",
-                    model=self.model,
-                    tokenizer=self.tokenizer
-                )
-            else:
-                # Determine device for pipeline (0 for GPU, -1 for CPU)
-                pipeline_device = -1 if using_cpu_mode else (0 if torch.cuda.is_available() else -1)
-                self.pipeline = pipeline(
-                    "text-generation",
-                    model=self.model,
-                    tokenizer=self.tokenizer,
-                    device=pipeline_device
-                )
+            # Inference only: make sure dropout and other train-time layers are off
+            self.model.eval()
+            
+            # Context window, looked up once (tokenizers report ~1e30 when it is unset)
+            max_positions = getattr(self.model.config, "max_position_embeddings", 4096)
+            self.model_max_length = min(max_positions, getattr(self.tokenizer, "model_max_length", max_positions))
+            
+            if using_cpu_mode:
+                print("Running generation on CPU.")
             
         except Exception as e:
             error_msg = str(e)
@@ -181,17 +368,170 @@ class SQLQueryGenerator:
                 )
             raise RuntimeError(f"Error loading model: {error_msg}")
     
-    def _build_prompt(self, user_input: str, is_follow_up: bool = False) -> str:
+    @staticmethod
+    def _pick_dtype() -> torch.dtype:
         """
-        Build the prompt for the model following the exact format from requirements.
+        Pick the compute dtype: bfloat16 on GPUs that support it natively (Ampere+),
+        whose wider exponent range avoids fp16 overflow in outlier activations;
+        float16 on older GPUs (e.g. T4); float32 on CPU.
+        """
+        if torch.cuda.is_available():
+            return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        return torch.float32
+    
+    @staticmethod
+    def _quantization_kwargs(quant_mode: str, model_dtype: torch.dtype, device_map: str) -> Dict:
+        """Build from_pretrained overrides for a bitsandbytes quantization scheme ("nf4" or "int8")."""
+        from transformers import BitsAndBytesConfig
         
-        Args:
-            user_input: User's natural language input
-            is_follow_up: Whether this is a follow-up query
+        if quant_mode == "nf4":
+            # 4-bit weight-only: at batch size 1 decoding is memory-bandwidth
+            # bound, so fewer weight bytes per token beats LLM.int8 kernels.
+            # A 7B model fits in ~4GB, so no CPU offload is needed
+            return {
+                "quantization_config": BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=model_dtype,
+                    bnb_4bit_use_double_quant=True
+                )
+            }
+        
+        quant_kwargs = {
+            "quantization_config": BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_threshold=6.0,
+                llm_int8_enable_fp32_cpu_offload=True  # Enable CPU offloading for models that don't fit in GPU RAM
+            )
+        }
+        # Use balanced device_map for CPU offloading
+        if device_map == "auto":
+            quant_kwargs["device_map"] = "balanced"  # Better for CPU offloading
+        return quant_kwargs
+    
+    @staticmethod
+    def _select_attn_implementation(model_dtype: torch.dtype, device_map: str) -> str:
+        """
+        Pick the attention kernel: ATTN_IMPL env override, else FlashAttention-2 when
+        flash_attn is installed and the model runs in fp16/bf16 on an Ampere+ GPU,
+        else PyTorch SDPA.
+        """
+        attn_impl = os.getenv("ATTN_IMPL")
+        if attn_impl:
+            return attn_impl
+        
+        if (
+            torch.cuda.is_available()
+            and device_map != "cpu"
+            and model_dtype in (torch.float16, torch.bfloat16)
+            and torch.cuda.get_device_capability()[0] >= 8
+            and importlib.util.find_spec("flash_attn") is not None
+        ):
+            return "flash_attention_2"
+        
+        if torch.cuda.is_available():
+            # Let SDPA dispatch to its fused flash / memory-efficient kernels
+            torch.backends.cuda.enable_flash_sdp(True)
+            torch.backends.cuda.enable_mem_efficient_sdp(True)
+        return "sdpa"
+    
+    def _compile_model(self):
+        """
+        Compile the model forward pass with torch.compile.
+        
+        A static KV cache keeps decode-step shapes fixed, so the captured CUDA graph
+        is reused for every generated token instead of recompiling as the cache grows.
+        Only forward is compiled so the model keeps its class and generate().
+        """
+        try:
+            self.model.generation_config.cache_implementation = "static"
+            self.model.forward = torch.compile(
+                self.model.forward,
+                mode="reduce-overhead",
+                fullgraph=False
+            )
+            self.compiled = True
+            print("Model forward compiled with torch.compile (reduce-overhead).")
+        except Exception as e:
+            print(f"Warning: torch.compile failed, using eager mode: {str(e)}")
+    
+    def _build_bad_words_ids(self) -> List[List[int]]:
+        """
+        Tokenize dangerous SQL statement keywords into sequences banned at generation time.
+        
+        The logits for these sequences are masked during decoding, so the model
+        cannot produce DROP/DELETE/... instead of wasting a full decode that the
+        SafetyValidator would then reject. The validator still runs as a final check.
+        
+        Only the space-prefixed uppercase form is banned: lowercase or bare tokens
+        would also be masked inside string literals and identifiers ('drop', merged_at).
+        """
+        # Tokenized after a word so the keyword gets its in-sentence pieces
+        # (e.g. SentencePiece "▁DROP"); a leading " DROP" would start with a bare "▁"
+        anchor_ids = self.tokenizer("a", add_special_tokens=False).input_ids
+        bad_words = set()
+        for keyword in BANNED_STATEMENT_KEYWORDS:
+            ids = self.tokenizer(f"a {keyword}", add_special_tokens=False).input_ids
+            if ids[:len(anchor_ids)] != anchor_ids:
+                continue  # The anchor merged with the keyword; skip rather than guess
+            ids = ids[len(anchor_ids):]
+            # A tokenizer that splits the space off would leave the bare keyword,
+            # which matches mid-word; those keywords are left to the validator
+            if ids and self.tokenizer.decode(ids[:1]).strip():
+                bad_words.add(tuple(ids))
+        if not bad_words:
+            logger.warning("No decode-time keyword ban for this tokenizer; relying on SafetyValidator")
+        return [list(ids) for ids in sorted(bad_words)]
+    
+    def _build_prefix_cache(self):
+        """
+        Run the static prompt prefix through the model once and keep its KV cache.
+        
+        Generations whose prompt starts with the same tokens reuse a copy of the
+        cache, so prefill only covers the conversation context and question.
+        """
+        if self.compiled:
+            # The compiled model uses a static cache sized per generate call
+            return
+        try:
+            # Locate the prefix inside a fully formatted prompt so chat-template tokens are included
+            prefix = self._build_prompt_prefix()
+            probe = self._format_llama2_prompt(self._build_prompt("?"))
+            formatted_prefix = probe[:probe.index(prefix) + len(prefix)]
+            
+            prefix_ids = self.tokenizer(
+                formatted_prefix,
+                return_tensors="pt",
+                add_special_tokens=False
+            ).input_ids.to(self.model.device)
+            with torch.inference_mode():
+                outputs = self.model(prefix_ids, use_cache=True)
+            self.prefix_ids = prefix_ids
+            self.prefix_cache = outputs.past_key_values
+            print(f"Cached KV for {prefix_ids.shape[1]} prompt prefix tokens.")
             
+            # Requests only tokenize the text after the prefix, provided the tokenizer
+            # splits the prefix/suffix boundary the same way it splits the whole prompt
+            full_ids = self.tokenizer(probe, add_special_tokens=False).input_ids
+            suffix_ids = self.tokenizer(probe[len(formatted_prefix):], add_special_tokens=False).input_ids
+            if full_ids == prefix_ids[0].tolist() + suffix_ids:
+                self.prefix_text = formatted_prefix
+        except Exception as e:
+            print(f"Warning: Could not build prompt prefix cache: {str(e)}")
+    
+    def _build_prompt_prefix(self) -> str:
+        """
+        Build the static part of the prompt: instructions and schema.
+        
+        It is identical for every question, so the string is built once and its
+        KV cache is computed once (see _build_prefix_cache).
+        
         Returns:
-            Formatted prompt string
+            Prompt prefix string
         """
+        if self._prompt_prefix is not None:
+            return self._prompt_prefix
+        
         prompt_parts = []
         
         # System instructions - exact format from requirements
@@ -235,24 +575,32 @@ class SQLQueryGenerator:
         prompt_parts.append("SCHEMA INFORMATION:")
         prompt_parts.append(self.schema_analyzer.get_schema_prompt())
         
+        self._prompt_prefix = "\n".join(prompt_parts)
+        return self._prompt_prefix
+    
+    def _build_prompt(self, user_input: str, is_follow_up: bool = False) -> str:
+        """
+        Build the prompt for the model following the exact format from requirements.
+        
+        Args:
+            user_input: User's natural language input
+            is_follow_up: Whether this is a follow-up query
+            
+        Returns:
+            Formatted prompt string
+        """
         # Conversation context if follow-up
-        if is_follow_up:
+        context_block = ""
+        if is_follow_up and self.conversation_manager.history:
             context = self.conversation_manager.get_context_prompt()
             if context:
-                prompt_parts.append("")
-                prompt_parts.append("CONVERSATION CONTEXT:")
-                prompt_parts.append(context)
-                prompt_parts.append("")
-                prompt_parts.append("The user is asking for a follow-up query. Generate SQL that continues from the previous query.")
-        
-        # User input
-        prompt_parts.append("")
-        prompt_parts.append("USER QUESTION:")
-        prompt_parts.append(user_input)
-        prompt_parts.append("")
-        prompt_parts.append("SQL QUERY:")
+                context_block = (
+                    f"\n\nCONVERSATION CONTEXT:\n{context}\n\n"
+                    "The user is asking for a follow-up query. Generate SQL that continues from the previous query."
+                )
         
-        return "\n".join(prompt_parts)
+        # Only the context and the question vary; the prefix is built once
+        return f"{self._build_prompt_prefix()}{context_block}\n\nUSER QUESTION:\n{user_input}\n\nSQL QUERY:"
     
     def _extract_sql(self, generated_text: str) -> str:
         """
@@ -275,76 +623,47 @@ class SQLQueryGenerator:
             return ""
         
         # CRITICAL: Stop at "USER QUESTION:" or "SQL QUERY:" markers to prevent model from generating new prompts
-        # Find the first occurrence of these markers and cut text there
-        user_question_pos = text.upper().find('USER QUESTION:')
-        sql_query_pos = text.upper().find('SQL QUERY:')
-        
-        # Find the earliest position of these markers (but not at the start, as that's part of our prompt)
-        cutoff_pos = len(text)
-        if user_question_pos > 0:  # Only if not at position 0 (which would be our prompt)
-            cutoff_pos = min(cutoff_pos, user_question_pos)
-        if sql_query_pos > 0:  # Only if not at position 0
-            cutoff_pos = min(cutoff_pos, sql_query_pos)
-        
-        # Cut text at the first marker to prevent taking subsequent generated prompts
-        if cutoff_pos < len(text):
-            text = text[:cutoff_pos].strip()
+        # Cut text at the earliest marker, but not at the start, as that's part of our prompt
+        marker_match = _PROMPT_MARKER_RE.search(text, 1)
+        if marker_match:
+            text = text[:marker_match.start()].strip()
         
         # Look for SQL query after "SQL QUERY:" marker (in the original prompt format)
-        sql_match = re.search(
-            r'SQL QUERY:\s*(.*?)(?:\n\n|\n[A-Z]|USER QUESTION:|SQL QUERY:|$)',
-            text,
-            re.DOTALL | re.IGNORECASE
-        )
+        sql_match = _SQL_QUERY_RE.search(text)
         
         if sql_match:
             sql = sql_match.group(1).strip()
         else:
             # If no marker found, try to find SELECT statement directly
             # More flexible pattern to catch SELECT statements, but stop at USER QUESTION or SQL QUERY
-            select_match = re.search(
-                r'(SELECT\s+.*?)(?:\n\n|\n(?:Please|Note|Explanation|This|The query|USER QUESTION|SQL QUERY)|USER QUESTION:|SQL QUERY:|$)',
-                text,
-                re.DOTALL | re.IGNORECASE
-            )
+            select_match = _SELECT_BLOCK_RE.search(text)
             if select_match:
                 sql = select_match.group(1).strip()
             else:
                 # Try to find first SELECT statement with semicolon or end of text
-                select_match = re.search(r'(SELECT.*?)(?:;|USER QUESTION:|SQL QUERY:|$|\n\n)', text, re.DOTALL | re.IGNORECASE)
+                select_match = _SELECT_STATEMENT_RE.search(text)
                 if select_match:
                     sql = select_match.group(1).strip()
                 else:
                     # Last resort: if text contains SELECT, use everything up to first explanation or marker
-                    if 'SELECT' in text.upper():
+                    select_start = text.upper().find('SELECT')
+                    if select_start != -1:
                         # Find SELECT and take everything until explanation pattern, USER QUESTION, or SQL QUERY
-                        select_start = text.upper().find('SELECT')
                         sql = text[select_start:].strip()
-                        # Remove everything after common explanation patterns or markers
-                        for pattern in ['\n\nUSER QUESTION:', '\n\nSQL QUERY:', '\nUSER QUESTION:', '\nSQL QUERY:', 'USER QUESTION:', 'SQL QUERY:', '\n\n', '\nPlease', '\nNote', '\nExplanation']:
-                            if pattern.upper() in sql.upper():
-                                sql = sql.split(pattern)[0].strip() if pattern in sql else sql.split(pattern.upper())[0].strip()
-                                break
+                        # Remove everything after the first explanation pattern or marker
+                        cut_match = _LAST_RESORT_CUT_RE.search(sql)
+                        if cut_match:
+                            sql = sql[:cut_match.start()].strip()
                     else:
                         sql = text.strip()
         
-        # Clean up the SQL - remove markdown code blocks and chat format tokens
-        sql = re.sub(r'```sql\s*', '', sql, flags=re.IGNORECASE)
-        sql = re.sub(r'```\s*', '', sql)
-        # Remove LLaMA-2 chat format tokens that might appear in output
-        sql = re.sub(r'\[/INST\]\s*', '', sql, flags=re.IGNORECASE)
-        sql = re.sub(r'\[INST\]\s*', '', sql, flags=re.IGNORECASE)
-        sql = re.sub(r'<s>\s*', '', sql, flags=re.IGNORECASE)
-        sql = re.sub(r'</s>\s*', '', sql, flags=re.IGNORECASE)
+        # Clean up the SQL - remove markdown code blocks and LLaMA-2 chat format tokens in one pass
+        sql = _STRIP_TOKENS_RE.sub('', sql)
         
         # Remove any explanatory text that might follow the SQL
         # Stop at common explanation patterns
-        explanation_patterns = [
-            r'(.*?)(?:Please|Note|Explanation|This query|The query|This will|This returns)',
-            r'(.*?)(?:--.*$)',
-        ]
-        for pattern in explanation_patterns:
-            match = re.search(pattern, sql, re.DOTALL | re.IGNORECASE)
+        for pattern in (_EXPLANATION_RE, _TRAILING_COMMENT_RE):
+            match = pattern.search(sql)
             if match:
                 sql = match.group(1).strip()
         
@@ -356,19 +675,19 @@ class SQLQueryGenerator:
                 continue
             
             # CRITICAL: Stop if we hit "USER QUESTION:" or "SQL QUERY:" markers (model is generating new prompts)
-            if 'USER QUESTION:' in line.upper() or 'SQL QUERY:' in line.upper():
+            if _PROMPT_MARKER_RE.search(line):
                 break
             
             # Stop if we hit chat format tokens
             if '[/INST]' in line or '[INST]' in line:
                 # Remove the token and everything after it
-                line = re.sub(r'\[/INST\].*$', '', line, flags=re.IGNORECASE)
+                line = _INST_TAIL_RE.sub('', line)
                 if line.strip():
                     sql_lines.append(line.strip())
                 break
             
             # Stop if we hit an explanation
-            if re.match(r'^(Please|Note|Explanation|This|The query|This will|This returns)', line, re.IGNORECASE):
+            if _EXPLANATION_LINE_RE.match(line):
                 break
             
             # Stop if we hit a comment that's not SQL-style
@@ -380,9 +699,7 @@ class SQLQueryGenerator:
         sql = ' '.join(sql_lines).strip()
         
         # Remove any remaining "USER QUESTION:" or "SQL QUERY:" text that might have been included
-        sql = re.sub(r'USER QUESTION:.*$', '', sql, flags=re.IGNORECASE | re.DOTALL)
-        sql = re.sub(r'SQL QUERY:.*$', '', sql, flags=re.IGNORECASE | re.DOTALL)
-        sql = sql.strip()
+        sql = _PROMPT_MARKER_TAIL_RE.sub('', sql).strip()
         
         # Ensure it ends properly
         if sql and not sql.endswith(';'):
@@ -400,50 +717,7 @@ class SQLQueryGenerator:
         Returns:
             True if the query is SQL-related, False otherwise
         """
-        input_lower = user_input.lower().strip()
-        
-        # Common greetings and non-SQL questions
-        greetings = [
-            'привет', 'hello', 'hi', 'hey', 'здравствуй', 'добрый',
-            'как дела', 'how are you', 'как поживаешь', 'что нового',
-            'спасибо', 'thanks', 'thank you', 'благодарю',
-            'пока', 'bye', 'до свидания', 'goodbye',
-            'как тебя зовут', 'what is your name', 'who are you',
-            'что ты умеешь', 'what can you do', 'что ты делаешь',
-            'помощь', 'help', 'помоги', 'help me'
-        ]
-        
-        # Check for greetings
-        for greeting in greetings:
-            if greeting in input_lower:
-                return False
-        
-        # SQL/database related keywords that indicate a real query
-        sql_keywords = [
-            'select', 'show', 'find', 'get', 'count', 'sum', 'avg', 'max', 'min',
-            'where', 'from', 'table', 'database', 'query',
-            'транзакц', 'transaction', 'данные', 'data', 'записи', 'records',
-            'сколько', 'how many', 'count', 'посчитай', 'calculate',
-            'покажи', 'show me', 'выведи', 'display', 'get',
-            'найди', 'find', 'ищи', 'search', 'filter',
-            'в', 'in', 'из', 'from', 'от', 'from',
-            'дата', 'date', 'время', 'time', 'год', 'year', 'месяц', 'month',
-            'город', 'city', 'сумма', 'amount', 'категория', 'category',
-            'больше', 'more than', 'greater', 'меньше', 'less than',
-            'между', 'between', 'и', 'and', 'или', 'or'
-        ]
-        
-        # Check if input contains SQL-related keywords
-        for keyword in sql_keywords:
-            if keyword in input_lower:
-                return True
-        
-        # If input is very short and doesn't contain SQL keywords, likely not a query
-        if len(input_lower.split()) <= 3 and not any(kw in input_lower for kw in sql_keywords):
-            return False
-        
-        # Default: assume it might be a query if it's not clearly a greeting
-        return True
+        return _is_sql_related_text(user_input.strip().lower())
     
     def generate(
         self,
@@ -466,13 +740,133 @@ class SQLQueryGenerator:
         Returns:
             Generated SQL query string
         """
+        prepared = self._prepare_prompt(user_input)
+        if isinstance(prepared, str):
+            return prepared
+        sanitized_input, formatted_prompt = prepared
+        
+        # Generate SQL
+        try:
+            inputs = self._model_inputs(formatted_prompt)
+            prompt_length = inputs["input_ids"].shape[1]
+            with self._generate_lock, torch.inference_mode():
+                output_ids = self.model.generate(
+                    **inputs,
+                    **self._generation_kwargs(max_length, prompt_length)
+                )
+            # Decode only the new tokens, not the echoed prompt
+            generated_text = self.tokenizer.decode(output_ids[0, prompt_length:], skip_special_tokens=True)
+            return self._finalize_output(sanitized_input, generated_text)
+            
+        except Exception as e:
+            return f"-- ERROR: Failed to generate SQL - {str(e)}"
+    
+    def generate_stream(self, user_input: str, max_length: int = 256) -> Iterator[str]:
+        """
+        Generate SQL query, yielding the raw output as tokens are decoded.
+        
+        Args:
+            user_input: Natural language question
+            max_length: Maximum number of new tokens
+            
+        Yields:
+            Growing partial model output; the last item is the final extracted
+            and validated SQL query (or an error comment)
+        """
+        prepared = self._prepare_prompt(user_input)
+        if isinstance(prepared, str):
+            yield prepared
+            return
+        sanitized_input, formatted_prompt = prepared
+        
+        try:
+            inputs = self._model_inputs(formatted_prompt)
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            errors = []
+            
+            def run_generation():
+                try:
+                    with self._generate_lock, torch.inference_mode():
+                        self.model.generate(
+                            **inputs,
+                            streamer=streamer,
+                            **self._generation_kwargs(max_length, inputs["input_ids"].shape[1])
+                        )
+                except Exception as e:
+                    # Unblock the consumer loop below
+                    errors.append(e)
+                    streamer.end()
+            
+            thread = threading.Thread(target=run_generation, daemon=True)
+            thread.start()
+            
+            generated_text = ""
+            for chunk in streamer:
+                generated_text += chunk
+                yield generated_text
+            thread.join()
+            
+            if errors:
+                raise errors[0]
+            yield self._finalize_output(sanitized_input, generated_text)
+            
+        except Exception as e:
+            yield f"-- ERROR: Failed to generate SQL - {str(e)}"
+    
+    def generate_batch(self, user_inputs: List[str], max_length: int = 256) -> List[str]:
+        """
+        Generate SQL queries for several questions with one padded model call.
+        
+        Args:
+            user_inputs: Natural language questions
+            max_length: Maximum number of new tokens per question
+            
+        Returns:
+            Generated SQL query (or error comment) for each question, in order
+        """
+        results: List[Optional[str]] = [None] * len(user_inputs)
+        pending = []
+        for i, user_input in enumerate(user_inputs):
+            prepared = self._prepare_prompt(user_input)
+            if isinstance(prepared, str):
+                results[i] = prepared
+            else:
+                pending.append((i, *prepared))
+        
+        if pending:
+            try:
+                # Left-padded (see _load_model), so every row's new tokens start at the same column
+                inputs = self._batch_model_inputs([formatted_prompt for _, _, formatted_prompt in pending])
+                prompt_length = inputs["input_ids"].shape[1]
+                with self._generate_lock, torch.inference_mode():
+                    output_ids = self.model.generate(
+                        **inputs,
+                        **self._generation_kwargs(max_length, prompt_length)
+                    )
+                generated_texts = self.tokenizer.batch_decode(output_ids[:, prompt_length:], skip_special_tokens=True)
+                for (i, sanitized_input, _), generated_text in zip(pending, generated_texts):
+                    results[i] = self._finalize_output(sanitized_input, generated_text)
+            except Exception as e:
+                for i, _, _ in pending:
+                    results[i] = f"-- ERROR: Failed to generate SQL - {str(e)}"
+        
+        return results
+    
+    def _prepare_prompt(self, user_input: str) -> Union[str, Tuple[str, str]]:
+        """
+        Validate user input and build the model prompt.
+        
+        Returns:
+            (sanitized_input, formatted_prompt), or an error/refusal comment string
+            if the input should not reach the model
+        """
         # Validate input is not empty
         if not user_input or not str(user_input).strip():
             return "-- ERROR: Empty query provided. Please enter a question."
         
         # Check if the query is SQL-related
         if not self._is_sql_related_query(user_input):
-            return "-- This is not a SQL query request. Please ask questions about the database, such as:\n--   - 'Show me all transactions above $1000'\n--   - 'Count transactions in Almaty in November 2023'\n--   - 'Find transactions between dates'\n--   etc."
+            return NOT_SQL_RESPONSE
         
         # Sanitize input
         try:
@@ -481,79 +875,189 @@ class SQLQueryGenerator:
             # Per requirement: "If the user asks for something unsafe, politely refuse."
             return f"-- ERROR: {str(e)}"
         
-        # Check if this is a follow-up query
-        is_follow_up = self.conversation_manager.is_follow_up(sanitized_input)
+        # Check if this is a follow-up query (never on the first turn)
+        is_follow_up = bool(self.conversation_manager.history) and self.conversation_manager.is_follow_up(sanitized_input)
         
         # Build prompt using LLaMA-2 chat format (Nous-Hermes is based on LLaMA-2)
         prompt = self._build_prompt(sanitized_input, is_follow_up)
         
         # Format for Nous-Hermes (uses LLaMA-2 chat format)
-        formatted_prompt = self._format_llama2_prompt(prompt)
+        return sanitized_input, self._format_llama2_prompt(prompt)
+    
+    def _generation_kwargs(self, max_length: int, prompt_length: int) -> Dict:
+        """
+        Decoding arguments shared by every model.generate call.
         
-        # Generate SQL
-        try:
-            # Get model's max length from tokenizer or model config
-            model_max_length = getattr(self.tokenizer, 'model_max_length', None)
-            if model_max_length is None or model_max_length > 100000:  # Some tokenizers have very large defaults
-                model_max_length = getattr(self.model.config, 'max_position_embeddings', 4096)
-            
-            # Use greedy decoding (do_sample=False) for faster and more deterministic generation
-            # This avoids the temperature/top_p warning and is faster than sampling
-            # Only use max_new_tokens to avoid the warning about both being set
-            # Set truncation=False to avoid the warning (model will handle length limits naturally)
-            outputs = self.pipeline(
-                formatted_prompt,
-                max_new_tokens=max_length,  # Maximum new tokens to generate
-                do_sample=False,  # Greedy decoding for speed (faster than sampling)
-                num_return_sequences=1,
-                pad_token_id=self.tokenizer.eos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
-                return_full_text=False,
-                truncation=False,  # Disable truncation to avoid warning (model handles limits)
-                use_cache=True  # Enable KV cache for faster generation
-            )
-            
-            generated_text = outputs[0]['generated_text']
-            print(f"Raw generated text: {generated_text[:500]}...")  # Log first 500 chars
-            
-            sql_query = self._extract_sql(generated_text)
-            print(f"Extracted SQL: {sql_query}")
-            
-            # Check if extracted SQL is empty
-            if not sql_query or not sql_query.strip():
-                print(f"WARNING: Extracted SQL is empty. Raw text was: {generated_text}")
-                # Try to return the raw text if extraction failed
-                if generated_text.strip():
-                    # If there's any text, try to find SELECT in it
-                    if 'SELECT' in generated_text.upper():
-                        # Return raw text as fallback
-                        return generated_text.strip()
-                    else:
-                        return f"-- ERROR: Could not extract SQL query from model output. Model generated: {generated_text[:200]}"
+        Args:
+            max_length: Maximum number of new tokens
+            prompt_length: Number of prompt tokens (input_ids columns) before generation
+        """
+        # Only use max_new_tokens to avoid the warning about both being set
+        return {
+            **self._static_generation_kwargs,
+            # Maximum new tokens to generate, kept inside the model's context window
+            "max_new_tokens": max(1, min(max_length, self.model_max_length - prompt_length)),
+            # End at the semicolon instead of decoding up to max_new_tokens
+            "stopping_criteria": StoppingCriteriaList([StopOnSubstrings(self.tokenizer, prompt_length)])
+        }
+    
+    def _model_inputs(self, formatted_prompt: str) -> Dict:
+        """
+        Tokenize a formatted prompt for model.generate, reusing the prompt prefix
+        KV cache when possible.
+        """
+        cached_inputs = self._prefix_cached_inputs(formatted_prompt)
+        if cached_inputs is not None:
+            return cached_inputs
+        # No truncation: cutting the prompt would drop the question or the schema
+        return self.tokenizer(
+            formatted_prompt,
+            return_tensors="pt",
+            add_special_tokens=False  # Prompt already carries the chat-format tokens
+        ).to(self.model.device)
+    
+    def _batch_model_inputs(self, formatted_prompts: List[str]) -> Dict:
+        """
+        Tokenize several formatted prompts into one left-padded batch, reusing the
+        prompt prefix KV cache when possible.
+        """
+        cached_inputs = self._prefix_cached_batch_inputs(formatted_prompts)
+        if cached_inputs is not None:
+            return cached_inputs
+        return self.tokenizer(
+            formatted_prompts,
+            return_tensors="pt",
+            padding=True,
+            add_special_tokens=False
+        ).to(self.model.device)
+    
+    def _prefix_cached_batch_inputs(self, formatted_prompts: List[str]) -> Optional[Dict]:
+        """
+        Build batched model.generate inputs that share the prompt prefix KV cache.
+        
+        Every row is the cached prefix followed by its own left-padded suffix; the
+        attention mask hides the padding in between, so the prefix is prefilled once
+        for the whole batch instead of once per row.
+        
+        Returns:
+            input_ids, attention_mask and a batch-sized copy of the prefix cache, or
+            None if no cache is available or any prompt does not extend the prefix
+        """
+        if self.prefix_cache is None or not hasattr(self.prefix_cache, "batch_repeat_interleave"):
+            return None
+        
+        suffixes = []
+        for formatted_prompt in formatted_prompts:
+            suffix_ids = self._prefix_suffix_ids(formatted_prompt)
+            if suffix_ids is None:
+                return None
+            suffixes.append(suffix_ids)
+        
+        padded = self.tokenizer.pad({"input_ids": suffixes}, padding=True, return_tensors="pt")
+        batch_size = len(suffixes)
+        prefix_ids = self.prefix_ids.expand(batch_size, -1)
+        past_key_values = copy.deepcopy(self.prefix_cache)
+        past_key_values.batch_repeat_interleave(batch_size)
+        
+        return {
+            "input_ids": torch.cat([prefix_ids, padded.input_ids.to(self.model.device)], dim=1),
+            "attention_mask": torch.cat([torch.ones_like(prefix_ids), padded.attention_mask.to(self.model.device)], dim=1),
+            "past_key_values": past_key_values
+        }
+    
+    def _prefix_cached_inputs(self, formatted_prompt: str) -> Optional[Dict]:
+        """
+        Build model.generate inputs that reuse the prompt prefix KV cache.
+        
+        Returns:
+            input_ids, attention_mask and a private copy of the prefix cache, or None
+            if no cache is available or the prompt does not extend the cached prefix
+        """
+        if self.prefix_cache is None:
+            return None
+        
+        suffix_ids = self._prefix_suffix_ids(formatted_prompt)
+        if suffix_ids is None:
+            return None
+        input_ids = torch.cat(
+            [self.prefix_ids, torch.tensor([suffix_ids], dtype=self.prefix_ids.dtype, device=self.prefix_ids.device)],
+            dim=1
+        )
+        
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            # generate() appends to the cache, so each call gets its own copy
+            "past_key_values": copy.deepcopy(self.prefix_cache)
+        }
+    
+    def _prefix_suffix_ids(self, formatted_prompt: str) -> Optional[List[int]]:
+        """
+        Token ids of the part of a formatted prompt that follows the cached prefix.
+        
+        Returns:
+            Suffix token ids, or None if the prompt does not extend the cached prefix
+        """
+        if self.prefix_text is not None:
+            # Skip re-tokenizing the ~1.5k-token prefix on every request
+            if not formatted_prompt.startswith(self.prefix_text):
+                return None
+            suffix_ids = self.tokenizer(
+                formatted_prompt[len(self.prefix_text):],
+                add_special_tokens=False
+            ).input_ids
+            return suffix_ids or None
+        
+        ids = self.tokenizer(formatted_prompt, add_special_tokens=False).input_ids
+        prefix_length = self.prefix_ids.shape[1]
+        if len(ids) <= prefix_length or ids[:prefix_length] != self.prefix_ids[0].tolist():
+            return None
+        return ids[prefix_length:]
+    
+    def _finalize_output(self, sanitized_input: str, generated_text: str) -> str:
+        """
+        Extract and validate SQL from raw model output, recording it in history.
+        
+        Returns:
+            SQL query, or an error/clarification comment string
+        """
+        sql_query = self._extract_sql(generated_text)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Raw generated text: %s...", generated_text[:500])  # Log first 500 chars
+            logger.debug("Extracted SQL: %s", sql_query)
+        
+        # Check if extracted SQL is empty
+        if not sql_query or not sql_query.strip():
+            logger.warning("Extracted SQL is empty. Raw text was: %s", generated_text)
+            # Try to return the raw text if extraction failed
+            if generated_text.strip():
+                # If there's any text, try to find SELECT in it
+                if 'SELECT' in generated_text.upper():
+                    # Return raw text as fallback
+                    return generated_text.strip()
                 else:
-                    return "-- ERROR: Model generated empty response. Please try again."
-            
-            # Check if model asked for clarification (ambiguous question)
-            if any(phrase in generated_text.lower() for phrase in ['clarification', 'ambiguous', 'unclear', 'please specify']):
-                # Return a comment indicating clarification is needed
-                return "-- Please clarify your question. The request is ambiguous."
-            
-            # Validate the generated SQL
-            is_valid, error_msg = self.safety_validator.validate(sql_query)
-            
-            if not is_valid:
-                # Per requirement: "If the user asks for something unsafe, politely refuse."
-                print(f"Validation failed: {error_msg}")
-                return f"-- ERROR: {error_msg}"
-            
-            # Add to conversation history
-            self.conversation_manager.add_turn(sanitized_input, sql_query)
-            
-            # Return SQL ONLY - no explanations
-            return sql_query
-            
-        except Exception as e:
-            return f"-- ERROR: Failed to generate SQL - {str(e)}"
+                    return f"-- ERROR: Could not extract SQL query from model output. Model generated: {generated_text[:200]}"
+            else:
+                return "-- ERROR: Model generated empty response. Please try again."
+        
+        # Check if model asked for clarification (ambiguous question)
+        if any(phrase in generated_text.lower() for phrase in ['clarification', 'ambiguous', 'unclear', 'please specify']):
+            # Return a comment indicating clarification is needed
+            return "-- Please clarify your question. The request is ambiguous."
+        
+        # Validate the generated SQL
+        is_valid, error_msg = self.safety_validator.validate(sql_query)
+        
+        if not is_valid:
+            # Per requirement: "If the user asks for something unsafe, politely refuse."
+            logger.warning("Validation failed: %s", error_msg)
+            return f"-- ERROR: {error_msg}"
+        
+        # Add to conversation history
+        self.conversation_manager.add_turn(sanitized_input, sql_query)
+        
+        # Return SQL ONLY - no explanations
+        return sql_query
     
     def _format_llama2_prompt(self, prompt: str) -> str:
         """
@@ -566,27 +1070,64 @@ class SQLQueryGenerator:
         Returns:
             Formatted prompt for Nous-Hermes
         """
+        if self._chat_wrapper is None:
+            self._chat_wrapper = self._build_chat_wrapper()
+        chat_prefix, chat_suffix = self._chat_wrapper
+        return f"{chat_prefix}{prompt}{chat_suffix}"
+    
+    def _build_chat_wrapper(self) -> Tuple[str, str]:
+        """
+        Render the chat template once around a placeholder and split it, so each
+        request only concatenates strings instead of re-running the Jinja template.
+        
+        Returns:
+            (text before the user prompt, text after the user prompt)
+        """
         # Nous-Hermes (based on LLaMA-2) uses [INST] ... [/INST] format
         # Try to use the tokenizer's chat template if available
         system_msg = "You are an advanced SQL Query Generator. Output ONLY ONE SQL SELECT query in English, no explanations, no additional text. Stop immediately after the semicolon. Do NOT generate 'USER QUESTION:' or 'SQL QUERY:' markers. ALL SQL queries, values, column names, and string literals MUST be in English, regardless of the question language."
+        placeholder = "§USER§"  # Never occurs in a real prompt
+        # Fallback format for Nous-Hermes (LLaMA-2 based)
+        fallback = (f"<s>[INST] <<SYS>>\n{system_msg}\n<</SYS>>\n\n", " [/INST]")
         
         if hasattr(self.tokenizer, 'apply_chat_template') and self.tokenizer.chat_template:
             messages = [
                 {"role": "system", "content": system_msg},
-                {"role": "user", "content": prompt}
+                {"role": "user", "content": placeholder}
             ]
             try:
-                return self.tokenizer.apply_chat_template(
+                rendered = self.tokenizer.apply_chat_template(
                     messages,
                     tokenize=False,
                     add_generation_prompt=True
                 )
-            except:
+            except Exception:
                 # Fallback to LLaMA-2 format if chat template fails (Nous-Hermes uses LLaMA-2 format)
-                return f"<s>[INST] <<SYS>>\n{system_msg}\n<</SYS>>\n\n{prompt} [/INST]"
-        else:
-            # Fallback format for Nous-Hermes (LLaMA-2 based)
-            return f"<s>[INST] <<SYS>>\n{system_msg}\n<</SYS>>\n\n{prompt} [/INST]"
+                return fallback
+            if rendered.count(placeholder) == 1:
+                chat_prefix, chat_suffix = rendered.split(placeholder)
+                return chat_prefix, chat_suffix
+        return fallback
+    
+    def warmup(self):
+        """
+        Run a generation on a real schema prompt so CUDA kernels (and the prefix
+        cache path) are initialized with serving shapes before the first user request.
+        
+        When the model is compiled, the static cache is sized for the whole context
+        window; generate() reuses a static cache that is at least as long, so
+        single-question requests keep this cache and the captured decode step.
+        Prefill still recompiles for prompt lengths it has not seen yet.
+        """
+        formatted_prompt = self._format_llama2_prompt(self._build_prompt("How many rows are in the table?"))
+        inputs = self._model_inputs(formatted_prompt)
+        prompt_length = inputs["input_ids"].shape[1]
+        generation_kwargs = self._generation_kwargs(1, prompt_length)
+        if self.compiled:
+            # Decode a full answer so the decode step is captured; stopping criteria still end it early
+            generation_kwargs["max_new_tokens"] = max(1, self.model_max_length - prompt_length)
+        with self._generate_lock, torch.inference_mode():
+            self.model.generate(**inputs, **generation_kwargs)
     
     def get_schema_info(self) -> Dict:
         """Get schema information."""
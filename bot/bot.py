@@ -1,22 +1,63 @@
 import os
+import sys
+import json
 import asyncio
+import time
+from contextlib import suppress
+from collections import OrderedDict
+from html import escape
+from typing import Optional
+
 import aiohttp
 from dotenv import load_dotenv
 
-import pandas as pd
-import matplotlib.pyplot as plt
+try:
+    import orjson
+except ImportError:  # orjson is optional, json is used as a fallback
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:  # uvloop is optional, the default asyncio loop is used as a fallback
+    uvloop = None
 
-from aiogram import Bot, Dispatcher, types
-from aiogram.enums import ParseMode
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.enums import ChatAction, ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import Message
 from aiogram.filters import Command
 
+from formatting import MESSAGE_LIMIT, build_reply, generate_histogram, prepare_results, results_csv
+
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000/ask")
 
+# JSON для backend: orjson (C) если установлен, иначе stdlib
+json_loads = orjson.loads if orjson else json.loads
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def json_dumps(payload) -> bytes:
+    if orjson:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode("utf-8")
+
+
+# Максимальная длина подписи к фото в Telegram
+CAPTION_LIMIT = 1024
+
+NO_HISTOGRAM_NOTE = "\n\nℹ️ Недостаточно числовых данных для построения гистограммы."
+
+# Telegram сбрасывает статус «печатает…» примерно через 5 секунд
+TYPING_INTERVAL = 4  # секунд
+
+# Кэш успешных ответов backend: повторный запрос не идёт в backend
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL = 60  # секунд
+query_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
 bot = Bot(
     token=TELEGRAM_TOKEN,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
@@ -24,6 +65,10 @@ bot = Bot(
 
 dp = Dispatcher()
 
+# Общая HTTP-сессия к backend: пул соединений и keep-alive между запросами.
+# Создаётся в main(), закрывается при остановке бота
+http_session: Optional[aiohttp.ClientSession] = None
+
 
 # --------------------------
 # /start
@@ -41,100 +86,134 @@ async def cmd_start(message: Message):
 
 
 # --------------------------
-# Табличный вывод (ASCII)
+# Кэш запросов (LRU с TTL)
 # --------------------------
-def format_table(results):
-    if not results:
-        return "No data"
-
-    columns = list(results[0].keys())
+def cache_get(key: str):
+    entry = query_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if expires_at < time.monotonic():
+        del query_cache[key]
+        return None
+    query_cache.move_to_end(key)
+    return value
 
-    col_widths = {col: len(col) for col in columns}
-    for row in results:
-        for col in columns:
-            col_widths[col] = max(col_widths[col], len(str(row[col])))
 
-    header = " | ".join(col.ljust(col_widths[col]) for col in columns)
-    divider = "-+-".join("-" * col_widths[col] for col in columns)
+def cache_put(key: str, value):
+    query_cache[key] = (time.monotonic() + QUERY_CACHE_TTL, value)
+    query_cache.move_to_end(key)
+    while len(query_cache) > QUERY_CACHE_SIZE:
+        query_cache.popitem(last=False)
 
-    rows = []
-    for row in results:
-        line = " | ".join(str(row[col]).ljust(col_widths[col]) for col in columns)
-        rows.append(line)
 
-    return header + "\n" + divider + "\n" + "\n".join(rows)
+# --------------------------
+# Индикатор «печатает…»
+# --------------------------
+async def keep_typing(chat_id: int):
+    # Повторяется, пока задачу не отменят; ошибки индикатора не влияют на ответ
+    while True:
+        with suppress(Exception):
+            await bot.send_chat_action(chat_id, ChatAction.TYPING)
+        await asyncio.sleep(TYPING_INTERVAL)
 
 
 # --------------------------
-# Построение гистограммы
+# Запрос к backend
 # --------------------------
-def generate_histogram(df: pd.DataFrame, output_file="histogram.png"):
-    # Выбираем только числовые колонки
-    numeric_cols = df.select_dtypes(include='number').columns
-    if numeric_cols.empty:
-        return False  # Нет числовых колонок
-
-    plt.figure(figsize=(8, 5))
-    df[numeric_cols].hist(bins=10, figsize=(8, 5))
-    plt.tight_layout()
-    plt.savefig(output_file)
-    plt.close()
-    return True
+async def ask_backend(query: str) -> dict:
+    async with http_session.post(
+        BACKEND_URL,
+        data=json_dumps({"query": query}),
+        headers=JSON_HEADERS
+    ) as resp:
+        return await resp.json(loads=json_loads)
 
 
 # --------------------------
 # Основная обработка текстовых запросов
 # --------------------------
-@dp.message()
+@dp.message(F.text)  # Стикеры, фото и т.п. сюда не попадают
 async def handle_query(message: Message):
-    query = message.text.strip()
-
-    await message.answer("⏳ Выполняю запрос... Это может занять пару минут...")
+    if not (query := message.text.strip()):
+        return
+    # Запросы, отличающиеся только пробелами и регистром, считаются одинаковыми
+    cache_key = " ".join(query.split()).lower()
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                BACKEND_URL,
-                json={"query": query},
-                timeout=300
-            ) as resp:
-                resp_json = await resp.json()
-
-        if not resp_json.get("success"):
-            return await message.answer(f"❌ Ошибка: {resp_json.get('error')}")
+        cached = cache_get(cache_key)
+        if cached is None:
+            # Индикатор «печатает…» вместо отдельного сообщения; запрос к backend идёт параллельно
+            typing_task = asyncio.create_task(keep_typing(message.chat.id))
+            try:
+                resp_json = await ask_backend(query)
+            finally:
+                typing_task.cancel()
+
+            if not resp_json.get("success"):
+                return await message.answer(f"❌ Ошибка: {escape(str(resp_json.get('error')))}")
+            df = None
+        else:
+            resp_json, df = cached
 
         sql = resp_json["sql"]
         results = resp_json["results"]
         count = resp_json["count"]
         exec_time = resp_json["execution_time"]
 
-        table_text = format_table(results)
-        df = pd.DataFrame(results)
-
-        # Отправляем таблицу
-        text = (
-            f"<b>✅ Запрос выполнен</b>\n\n"
-            f"<b>SQL:</b>\n<code>{sql}</code>\n\n"
-            f"<b>Rows:</b> {count}\n"
-            f"<b>Execution:</b> {exec_time} ms\n\n"
-            f"<pre>{table_text}</pre>"
-        )
-        await message.answer(text)
-
-        # Построение гистограммы
-        if generate_histogram(df):
-            await message.answer_photo(types.FSInputFile("histogram.png"), caption="📊 Гистограмма числовых данных")
+        # Форматирование и DataFrame — O(строк·колонок), не на event loop
+        df, numeric_cols, table_text = await asyncio.to_thread(prepare_results, results, df)
+        if cached is None:
+            # DataFrame кэшируется вместе с ответом, чтобы не строить его повторно
+            cache_put(cache_key, (resp_json, df))
+
+        # Построение гистограммы в отдельном потоке, чтобы не блокировать event loop
+        png = await asyncio.to_thread(generate_histogram, df, numeric_cols) if numeric_cols else None
+
+        note = "" if png else NO_HISTOGRAM_NOTE
+        text, shown = build_reply(sql, count, exec_time, table_text, len(results), MESSAGE_LIMIT - len(note))
+
+        if shown < len(results):
+            # CSV уходит первым: сбой отправки текста не должен терять полный результат
+            csv_bytes = await asyncio.to_thread(results_csv, results, df)
+            await message.answer_document(types.BufferedInputFile(csv_bytes, filename="results.csv"))
+
+        if png:
+            photo = types.BufferedInputFile(png, filename="histogram.png")
+            if len(text) <= CAPTION_LIMIT:
+                # Таблица и гистограмма одним сообщением
+                await message.answer_photo(photo, caption=text)
+            else:
+                await message.answer(text)
+                await message.answer_photo(photo, caption="📊 Гистограмма числовых данных")
         else:
-            await message.answer("ℹ️ Нет числовых колонок для построения гистограммы.")
+            await message.answer(text + note)
 
     except Exception as e:
-        await message.answer(f"❌ Ошибка:\n<code>{str(e)}</code>")
+        await message.answer(f"❌ Ошибка:\n<code>{escape(str(e))}</code>")
 
 
 async def main():
+    global http_session
+    # backend (uvicorn) говорит только HTTP/1.1, поэтому вместо HTTP/2-мультиплексирования —
+    # ограниченный пул keep-alive соединений
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=50, keepalive_timeout=75, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=300)
+    )
     print("Bot started...")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await http_session.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop (libuv) снижает накладные расходы event loop на сокетах aiohttp/aiogram
+    if uvloop is None:
+        asyncio.run(main())
+    elif sys.version_info >= (3, 12):
+        asyncio.run(main(), loop_factory=uvloop.new_event_loop)
+    else:
+        uvloop.install()
+        asyncio.run(main())
@@ -0,0 +1,187 @@
+"""
+Форматирование результатов SQL для Telegram: таблица, текст ответа, гистограмма.
+"""
+import io
+import math
+import threading
+from html import escape
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")  # Рендер без GUI: гистограммы строятся в рабочем потоке
+from matplotlib.figure import Figure
+
+# Сколько строк показывать в сообщении; полный результат уходит CSV-файлом
+MAX_PREVIEW_ROWS = 50
+# С этого числа строк таблицу форматирует pandas (to_string), меньше — format_table
+PANDAS_TABLE_MIN_ROWS = 20
+# Меньше строк — гистограмма бессмысленна (COUNT(*) и т.п.)
+MIN_HISTOGRAM_ROWS = 5
+# Telegram не обрезает, а отклоняет сообщения длиннее 4096 символов.
+# Теги HTML в лимит не входят, так что считать их вместе с текстом — с запасом
+MESSAGE_LIMIT = 4096
+
+# Ответ с результатом запроса
+RESULT_TEMPLATE = (
+    "<b>✅ Запрос выполнен</b>\n\n"
+    "<b>SQL:</b>\n<code>{sql}</code>\n\n"
+    "<b>Rows:</b> {count}\n"
+    "<b>Execution:</b> {exec_time} ms\n\n"
+    "<pre>{table}</pre>"
+)
+
+# Одна фигура на все гистограммы (без глобального состояния pyplot);
+# generate_histogram выполняется в потоках, поэтому доступ под блокировкой
+histogram_figure = Figure(figsize=(8, 5))
+histogram_lock = threading.Lock()
+
+
+# --------------------------
+# Табличный вывод (ASCII)
+# --------------------------
+def to_columns(results) -> dict:
+    """Список строк-словарей -> {колонка: [значения]} (один проход по ключам)."""
+    if not results:
+        return {}
+    return {col: [row[col] for row in results] for col in results[0]}
+
+
+def format_table(columnar: dict):
+    if not columnar:
+        return "No data"
+
+    columns = list(columnar)
+
+    # Каждая ячейка приводится к строке один раз; ширина — по колонке целиком
+    str_cols = [list(map(str, values)) for values in columnar.values()]
+    col_widths = [
+        max(len(col), max(map(len, cells), default=0))
+        for col, cells in zip(columns, str_cols)
+    ]
+
+    header = " | ".join(col.ljust(width) for col, width in zip(columns, col_widths))
+    divider = "-+-".join("-" * width for width in col_widths)
+    body = "\n".join(
+        " | ".join(cell.ljust(width) for cell, width in zip(cells, col_widths))
+        for cells in zip(*str_cols)
+    )
+
+    return f"{header}\n{divider}\n{body}"
+
+
+def render_table(columnar: dict, df: Optional[pd.DataFrame] = None) -> str:
+    """Текст таблицы для первых MAX_PREVIEW_ROWS строк результата."""
+    preview = {col: values[:MAX_PREVIEW_ROWS] for col, values in columnar.items()}
+    if not preview or len(next(iter(preview.values()))) <= PANDAS_TABLE_MIN_ROWS:
+        return format_table(preview)
+    # На больших выборках форматтер pandas быстрее цикла на Python
+    preview_df = df.head(MAX_PREVIEW_ROWS) if df is not None else pd.DataFrame(preview)
+    return preview_df.to_string(index=False, max_colwidth=30)
+
+
+def prepare_results(results, df: Optional[pd.DataFrame] = None):
+    """
+    CPU-часть обработки результата: числовые колонки, DataFrame (если нужен)
+    и текст таблицы. Вызывается через asyncio.to_thread.
+    """
+    # Строки транспонируются один раз; колонки общие для таблицы и DataFrame
+    columnar = to_columns(results)
+    # DataFrame нужен только для CSV и гистограммы; числовые колонки
+    # определяем по первой строке, не строя его
+    numeric_cols = numeric_columns(results)
+    if df is None and (numeric_cols or len(results) > MAX_PREVIEW_ROWS):
+        df = pd.DataFrame(columnar, copy=False)
+    return df, numeric_cols, render_table(columnar, df)
+
+
+def results_csv(results, df: Optional[pd.DataFrame] = None) -> bytes:
+    """Полный результат в CSV. Вызывается через asyncio.to_thread."""
+    if df is None:
+        df = pd.DataFrame(results)
+    return df.to_csv(index=False).encode("utf-8")
+
+
+# --------------------------
+# Построение гистограммы
+# --------------------------
+def numeric_columns(results) -> list:
+    """Числовые колонки по типам значений первой строки (без pandas)."""
+    if not results:
+        return []
+    return [
+        col for col, value in results[0].items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    ]
+
+
+def generate_histogram(df: pd.DataFrame, numeric_cols: list) -> Optional[bytes]:
+    """PNG гистограмм числовых колонок в памяти, или None, если рисовать нечего."""
+    if not numeric_cols or len(df) < MIN_HISTOGRAM_ROWS:
+        return None  # Нет числовых колонок или слишком мало строк
+
+    # Интервалы и частоты считает NumPy, matplotlib только рисует столбцы
+    try:
+        values = df[numeric_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+    except (TypeError, ValueError):
+        return None  # Колонка оказалась нечисловой дальше первой строки
+
+    # Пустые и константные колонки не рисуем
+    plot_cols = []
+    for col_idx, col in enumerate(numeric_cols):
+        column = values[:, col_idx]
+        column = column[~np.isnan(column)]
+        if column.size and column.min() != column.max():
+            plot_cols.append((col, column))
+    if not plot_cols:
+        return None
+
+    # Сетка как у DataFrame.hist: ближайший к квадрату размер
+    ncols = math.ceil(math.sqrt(len(plot_cols)))
+    nrows = math.ceil(len(plot_cols) / ncols)
+
+    with histogram_lock:
+        fig = histogram_figure
+        fig.clear()
+        axes = fig.subplots(nrows=nrows, ncols=ncols, squeeze=False).ravel()
+        for ax in axes[len(plot_cols):]:
+            fig.delaxes(ax)
+        for (col, column), ax in zip(plot_cols, axes):
+            counts, edges = np.histogram(column, bins=10)
+            ax.bar(edges[:-1], counts, width=np.diff(edges), align="edge")
+            ax.set_title(str(col))
+            ax.grid(True)
+        fig.tight_layout()
+        # PNG пишется в память, без временного файла на диске.
+        # zlib-сжатие PNG — основная стоимость savefig; уровень 1 вместо 6
+        buf = io.BytesIO()
+        fig.savefig(buf, dpi=80, format="png", pil_kwargs={"compress_level": 1, "optimize": False})
+    return buf.getvalue()
+
+
+# --------------------------
+# Текст ответа
+# --------------------------
+def build_reply(sql: str, count, exec_time, table_text: str, total_rows: int, limit: int = MESSAGE_LIMIT):
+    """
+    Текст ответа не длиннее limit символов: строки таблицы отбрасываются с конца,
+    пока сообщение не поместится. Возвращает (текст, число показанных строк).
+    """
+    # SQL и ячейки могут содержать < > &, которые ломают HTML-разметку Telegram
+    sql = escape(sql)
+    lines = [escape(line) for line in table_text.split("\n")]
+    # Строки над данными: заголовок (и разделитель у format_table)
+    header_lines = max(len(lines) - min(total_rows, MAX_PREVIEW_ROWS), 1)
+
+    shown = len(lines) - header_lines
+    while True:
+        table = "\n".join(lines[:header_lines + shown])
+        if shown == 0 and total_rows:
+            table = "(таблица не помещается в сообщение, см. CSV)"
+        text = RESULT_TEMPLATE.format(sql=sql, count=count, exec_time=exec_time, table=table)
+        if shown < total_rows:
+            text += f"\n<i>(показаны первые {shown} строк)</i>"
+        if len(text) <= limit or shown == 0:
+            return text, shown
+        shown -= 1